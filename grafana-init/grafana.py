@@ -19,11 +19,12 @@ import json
 import logging
 import os
 import sys
-import time
 import urllib
 
 from requests import Session, RequestException
 
+import retry_policy
+
 LOG_LEVEL = logging.getLevelName(os.environ.get('LOG_LEVEL', 'INFO'))
 logging.basicConfig(level=LOG_LEVEL)
 
@@ -42,25 +43,15 @@ DATASOURCE_AUTH_TOKEN = os.environ.get('DATASOURCE_AUTH_TOKEN', '')
 DASHBOARDS_DIR = os.environ.get('DASHBOARDS_DIR', '/dashboards.d')
 
 
+def log_response(exc):
+    response = getattr(exc, 'response', None)
+    if isinstance(exc, RequestException) and response is not None:
+        logger.debug('Response was: %r', response.text)
+
+
 def retry(retries=5, delay=2.0, exc_types=(RequestException,)):
-    def decorator(func):
-        def f_retry(*args, **kwargs):
-            for i in range(retries):
-                try:
-                    return func(*args, **kwargs)
-                except exc_types as exc:
-                    if i < retries - 1:
-                        logger.debug('Caught exception, retrying...',
-                                     exc_info=True)
-                        time.sleep(delay)
-                    else:
-                        logger.exception('Failed after %d attempts', retries)
-                        if isinstance(exc, RequestException):
-                            logger.debug('Response was: %r', exc.response)
-
-                        raise
-        return f_retry
-    return decorator
+    return retry_policy.retry(retries=retries, delay=delay,
+                              exc_types=exc_types, on_failure=log_response)
 
 
 def create_admin_login_payload():
@@ -189,6 +180,7 @@ def main():
     logging.info('Ending %r session...', admin_user.get('user'))
     admin_session.get('{url}/logout'.format(url=GRAFANA_URL))
 
+    retry_policy.log_stats(logger)
     logging.info('Finished successfully.')
 
 
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Benchmarks cleanup.py against the in-process FakeKubernetesAPI.
+
+For each worker count a fresh fake API is seeded with the given number of
+jobs, each with its pods, spread over a number of `app` labels with one
+reference pod per app. A fraction of the jobs is already complete, the rest
+complete at random times spread over a few seconds while the cleanup runs.
+
+In `app` mode one cleanup is run per app, one after the other, the way one
+cleanup job per release would. In `selectors` mode a single cleanup handles
+every app through CLEANUP_SELECTORS, and in `namespace` mode through
+CLEANUP_ALL_JOBS. Wall time, API calls and the number of jobs left behind
+are reported per run.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+import cleanup
+import kubernetes
+
+from kubernetes import KubernetesAPIClient
+
+# the fake API is shared by the benchmarks of all images
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'tools', 'fakes'))
+
+from fake_kubernetes_api import FakeKubernetesAPI
+
+NAMESPACE = 'benchmark'
+MODES = ('app', 'selectors', 'namespace')
+
+
+def _app(index):
+    return 'benchmark-{:d}'.format(index)
+
+
+def _reference_pod(index):
+    return 'cleanup-{:d}'.format(index)
+
+
+def _seed(api, jobs, pods, completed, apps):
+    api.add_namespace(NAMESPACE)
+    for a in range(apps):
+        api.add_pod(NAMESPACE, _reference_pod(a), {'app': _app(a),
+                                                   'component': 'cleanup'})
+
+    done = int(round(jobs * completed))
+    names = []
+    for i in range(jobs):
+        name = 'job-{:d}'.format(i)
+        api.add_job(NAMESPACE, name, {'app': _app(i % apps),
+                                      'component': name},
+                    pods=pods, complete=i < done)
+        if i >= done:
+            names.append(name)
+
+    api.reset_counts()
+    return names
+
+
+def _complete_later(api, names, spread, rng):
+    start = time.time()
+    for delay, name in sorted((rng.uniform(0, spread), name)
+                              for name in names):
+        time.sleep(max(0.0, start + delay - time.time()))
+        api.complete_job(NAMESPACE, name)
+
+
+def _run_cleanups(args, api):
+    if args.mode == 'app':
+        references = [_reference_pod(a) for a in range(args.apps)]
+    else:
+        references = [_reference_pod(0)]
+
+    cleanup.SELECTORS = []
+    cleanup.ALL_JOBS = args.mode == 'namespace'
+    if args.mode == 'selectors':
+        cleanup.SELECTORS = ['app={}'.format(_app(a))
+                             for a in range(args.apps)]
+
+    for reference in references:
+        # every cleanup job has its own client
+        client = KubernetesAPIClient(qps=args.qps, burst=args.burst)
+        client.api_url = api.url
+
+        os.environ['POD_NAME'] = reference
+        try:
+            cleanup.cleanup(cleanup.ApiCallStats(), client)
+        except SystemExit:
+            pass
+
+
+def run_case(args, workers):
+    api = FakeKubernetesAPI(latency=args.latency)
+    api.start()
+    try:
+        incomplete = _seed(api, args.jobs, args.pods, args.completed,
+                           args.apps)
+
+        cleanup.WORKERS = workers
+        cleanup.RETRY_DELAY = args.retry_delay
+        cleanup.JOB_DEADLINE = args.spread + 60
+        cleanup.collection_deletes_allowed = True
+
+        completer = threading.Thread(
+            target=_complete_later,
+            args=(api, incomplete, args.spread, random.Random(args.seed)))
+        completer.daemon = True
+
+        stdout = sys.stdout
+        if not args.verbose:
+            sys.stdout = open(os.devnull, 'w')
+
+        start = time.time()
+        completer.start()
+        try:
+            _run_cleanups(args, api)
+        finally:
+            elapsed = time.time() - start
+            if sys.stdout is not stdout:
+                sys.stdout.close()
+                sys.stdout = stdout
+
+        completer.join()
+        left = len(api.list('jobs', NAMESPACE)['items'])
+
+        return {
+            'mode': args.mode,
+            'apps': args.apps,
+            'jobs': args.jobs,
+            'workers': workers,
+            'seconds': elapsed,
+            'calls': api.total_calls(),
+            'left': left,
+            'call_counts': api.call_counts(),
+        }
+    finally:
+        api.stop()
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        prog='benchmark',
+        description='Benchmark job cleanup against a fake Kubernetes API')
+    parser.add_argument('--jobs', type=int, default=200,
+                        help='Number of jobs to clean up')
+    parser.add_argument('--pods', type=int, default=1,
+                        help='Pods per job')
+    parser.add_argument('--apps', type=int, default=1,
+                        help='Number of `app` labels the jobs are spread '
+                             'over')
+    parser.add_argument('--mode', choices=MODES, default='app',
+                        help='Clean up with one run per app, one run using '
+                             'CLEANUP_SELECTORS or one run using '
+                             'CLEANUP_ALL_JOBS')
+    parser.add_argument('--completed', type=float, default=0.5,
+                        help='Fraction of jobs complete when cleanup starts')
+    parser.add_argument('--spread', type=float, default=2.0,
+                        help='Seconds over which the other jobs complete')
+    parser.add_argument('--workers', default='1,4,16',
+                        help='Comma separated CLEANUP_WORKERS values')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Seconds of latency added to every API request')
+    parser.add_argument('--qps', type=float, default=kubernetes.QPS,
+                        help='Client side request rate limit, 0 to disable')
+    parser.add_argument('--burst', type=int, default=kubernetes.BURST,
+                        help='Client side request burst')
+    parser.add_argument('--retry-delay', type=float, default=1.0,
+                        help='WAIT_DELAY used by the cleanup')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the job completion times')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Show cleanup output and API calls per verb')
+    return parser
+
+
+def main(args=None):
+    args = _get_parser().parse_args(args)
+
+    # pods other than our own are used as label references
+    os.environ['NAMESPACE'] = NAMESPACE
+
+    workers = [int(w) for w in args.workers.split(',')]
+
+    results = []
+    for count in workers:
+        result = run_case(args, count)
+        results.append(result)
+        if args.verbose:
+            for call, n in sorted(result['call_counts'].items()):
+                print('    {:<28} {:>8d}'.format(call, n))
+
+    print('{:>10} {:>5} {:>8} {:>8} {:>10} {:>8} {:>6}'.format(
+        'mode', 'apps', 'jobs', 'workers', 'seconds', 'calls', 'left'))
+    for result in results:
+        print('{mode:>10} {apps:>5d} {jobs:>8d} {workers:>8d} '
+              '{seconds:>10.3f} {calls:>8d} {left:>6d}'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
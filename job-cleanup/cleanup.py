@@ -19,9 +19,20 @@ from __future__ import print_function
 import os
 import socket
 import sys
+import threading
 import time
 
+from collections import Counter, defaultdict
+from multiprocessing.pool import ThreadPool
+
+try:
+    from Queue import Empty, Queue
+except ImportError:
+    from queue import Empty, Queue
+
 from kubernetes import KubernetesAPIClient
+from kubernetes import shutdown_response
+from label_selector import selector_matches
 
 
 NAMESPACE = '/var/run/secrets/kubernetes.io/serviceaccount/namespace'
@@ -29,9 +40,53 @@ TIMEOUT = float(os.environ.get('WAIT_TIMEOUT', '10'))
 RETRIES = int(os.environ.get('WAIT_RETRIES', '24'))
 RETRY_DELAY = float(os.environ.get('WAIT_DELAY', '5.0'))
 
+# jobs torn down concurrently
+WORKERS = int(os.environ.get('CLEANUP_WORKERS', '4'))
+
+# how long each job may take to complete and be deleted before it is killed
+JOB_DEADLINE = float(os.environ.get('WAIT_DEADLINE', RETRIES * RETRY_DELAY))
+
 USE_KUBE_CONFIG = os.environ.get('USE_KUBE_CONFIG', False)
 
+# label selectors separated by `;`, jobs matching any of them are cleaned up
+# instead of those sharing the reference pod's `app` label
+SELECTORS = [s.strip() for s in os.environ.get('CLEANUP_SELECTORS',
+                                               '').split(';') if s.strip()]
+
+# clean up every job in the namespace
+ALL_JOBS = os.environ.get('CLEANUP_ALL_JOBS', 'false').lower() == 'true'
+
+# jobs whose pods are deleted by one request, bounds the selector's length
+POD_BATCH_SIZE = 50
+
+# seconds to wait for the job watch thread to end once cleanup is done
+WATCH_JOIN_TIMEOUT = 5.0
+
 pod_is_self = True
+collection_deletes_allowed = True
+
+
+class ApiCallStats(object):
+    """Counts API calls and the time spent in them, per operation."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.seconds = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, operation, seconds):
+        with self._lock:
+            self.calls[operation] += 1
+            self.seconds[operation] += seconds
+
+    def report(self, elapsed):
+        with self._lock:
+            total = sum(self.calls.values())
+            print('Cleanup took %.2fs and made %d API calls (%.2fs waiting '
+                  'on the API):' % (elapsed, total, sum(self.seconds.values())))
+            for operation, count in self.calls.most_common():
+                print('  %6d %8.2fs  %s' % (count, self.seconds[operation],
+                                            operation))
 
 
 def get_current_namespace():
@@ -59,35 +114,64 @@ def is_condition_complete(condition):
     return condition.type == 'Complete' and str(condition.status) == 'True'
 
 
-def try_delete_job(client, namespace, job, retries, force=False):
-    if 'conditions' not in job.status and not force:
-        print('Job has no conditions (probably still running), '
-              'will wait for it to finish: %s/%s (%d attempts '
-              'remaining)' % (namespace, job.metadata.name, retries))
-        return False, retries - 1
-
-    if not force:
-        complete = filter(is_condition_complete, job.status.conditions)
-        if not complete:
-            print('Job is not complete, will wait for it to finish: %s/%s (%d '
-                  'attempts remaining)' % (namespace, job.metadata.name, retries))
-            return False, retries - 1
-
-    grace_period = 0 if force else TIMEOUT
-    delete_options = {'propagationPolicy': 'Foreground',
-                      'gracePeriodSeconds': grace_period}
-
-    job_name = job.metadata.name
-    pods = client.get('/api/v1/namespaces/{}/pods', namespace,
-                      params={'labelSelector': 'job-name=%s' % job_name})
-    for pod in pods['items']:
-        if pod.metadata.labels.get('defunct') == 'true':
-            # we could exclude this in the labelSelector, but it's probably
-            # better to surface the weird pod state as much as possible
-            print('Pod is marked as defunct and will not be deleted: '
-                  '%s/%s' % (namespace, pod.metadata.name))
-            continue
-
+def is_condition_failed(condition):
+    return condition.type == 'Failed' and str(condition.status) == 'True'
+
+
+def is_job_complete(job):
+    status = job.get('status') or {}
+    return any(is_condition_complete(c)
+               for c in status.get('conditions') or [])
+
+
+def is_job_finished(job):
+    """:return: True if the job either completed or failed"""
+    status = job.get('status') or {}
+    return any(is_condition_complete(c) or is_condition_failed(c)
+               for c in status.get('conditions') or [])
+
+
+def delete_job_pods(client, namespace, job_name, delete_options,
+                    pods=None):
+    """
+    Deletes the pods of a job, except those labelled `defunct=true`, with a
+    single deletecollection request. Falls back to deleting the pods one at
+    a time if the collection delete is refused (e.g. not permitted).
+
+    :param pods: names of the job's pods if already listed; no request is
+                 made if this is empty
+    :return: True if all pods were deleted
+    """
+    global collection_deletes_allowed
+
+    if pods is not None and not pods:
+        # any pod started since the listing is removed along with the job,
+        # which is deleted with foreground propagation
+        return True
+
+    selector = 'job-name=%s,defunct!=true' % job_name
+    if collection_deletes_allowed:
+        ret = client.delete('/api/v1/namespaces/{}/pods', namespace,
+                            params={'labelSelector': selector},
+                            raise_for_status=False,
+                            json=delete_options)
+        if ret.status_code == 200:
+            for pod in ret.toDict().get('items') or []:
+                print('Deleted job pod %s/%s' % (namespace,
+                                                 pod['metadata']['name']))
+            return True
+
+        if ret.status_code not in (403, 405):
+            print('Failed to delete pods of job %s/%s: %r' % (
+                namespace, job_name, ret), file=sys.stderr)
+            return False
+
+        print('Collection deletes of pods are not allowed, deleting pods '
+              'individually', file=sys.stderr)
+        collection_deletes_allowed = False
+
+    for pod in client.list_iter('/api/v1/namespaces/{}/pods', namespace,
+                                label_selector=selector):
         del_status = client.delete('/api/v1/namespaces/{}/pods/{}',
                                    namespace, pod.metadata.name,
                                    raise_for_status=False,
@@ -97,12 +181,82 @@ def try_delete_job(client, namespace, job, retries, force=False):
         # it returns the full Pod on success, or a Status if fail
         # wat
         if del_status.status_code == 200:
-            print('Deleted job pod %s/%s' % (namespace, job.metadata.name))
+            print('Deleted job pod %s/%s' % (namespace, pod.metadata.name))
         else:
-            print('Failed to delete job pod %s/%s: %r (job: %s, %d attempts '
-                  'remaining' % (namespace, pod.metadata.name, del_status,
-                                 job.metadata.name, retries), file=sys.stderr)
-            return False, retries - 1
+            print('Failed to delete job pod %s/%s: %r (job: %s)' % (
+                namespace, pod.metadata.name, del_status, job_name),
+                file=sys.stderr)
+            return False
+
+    return True
+
+
+def get_delete_options(force):
+    return {'propagationPolicy': 'Foreground',
+            'gracePeriodSeconds': 0 if force else TIMEOUT}
+
+
+def delete_pods_of_jobs(client, namespace, jobs, job_pods, force=False):
+    """
+    Deletes the pods of many jobs with one deletecollection request per
+    POD_BATCH_SIZE jobs, using a `job-name in (...)` selector. The pods of
+    jobs handled this way are cleared from `job_pods` so try_delete_job()
+    won't delete them again; pods of the other jobs are left to it, e.g. if
+    collection deletes aren't permitted.
+
+    :param job_pods: pod names by job name, see find_jobs()
+    """
+    global collection_deletes_allowed
+
+    names = [job.metadata.name for job in jobs
+             if job_pods.get(job.metadata.name)]
+    for i in range(0, len(names), POD_BATCH_SIZE):
+        if not collection_deletes_allowed:
+            return
+
+        batch = names[i:i + POD_BATCH_SIZE]
+        selector = 'job-name in (%s),defunct!=true' % ','.join(batch)
+        ret = client.delete('/api/v1/namespaces/{}/pods', namespace,
+                            params={'labelSelector': selector},
+                            raise_for_status=False,
+                            json=get_delete_options(force))
+        if ret.status_code in (403, 405):
+            print('Collection deletes of pods are not allowed, deleting pods '
+                  'individually', file=sys.stderr)
+            collection_deletes_allowed = False
+            return
+
+        if ret.status_code != 200:
+            # try_delete_job() retries each job's pods on its own
+            continue
+
+        for pod in ret.toDict().get('items') or []:
+            print('Deleted job pod %s/%s' % (namespace,
+                                             pod['metadata']['name']))
+        for name in batch:
+            job_pods[name] = []
+
+
+def try_delete_job(client, namespace, job, force=False, pods=None,
+                   deletable=is_job_complete):
+    """
+    Deletes a complete job and its pods, or any job if `force` is set.
+
+    :param pods: names of the job's pods if already listed, see
+                 delete_job_pods()
+    :param deletable: predicate telling whether a job may be deleted
+    :return: True if the job was deleted
+    """
+    if not force and not deletable(job):
+        print('Job is not complete, will wait for it to finish: '
+              '%s/%s' % (namespace, job.metadata.name))
+        return False
+
+    delete_options = get_delete_options(force)
+
+    if not delete_job_pods(client, namespace, job.metadata.name,
+                           delete_options, pods):
+        return False
 
     ret = client.delete('/apis/batch/v1/namespaces/{}/jobs/{}',
                         namespace, job.metadata.name,
@@ -110,19 +264,271 @@ def try_delete_job(client, namespace, job, retries, force=False):
                         raise_for_status=False)
     if ret.status_code == 200:
         print('Deleted job %s/%s' % (namespace, job.metadata.name))
-        return True, 0
+        return True
+    else:
+        print('Failed to delete job %s/%s: %r' % (
+            namespace, job.metadata.name, ret), file=sys.stderr)
+
+        return False
+
+
+def watch_jobs(client, namespace, selector, events, stop, responses):
+    """
+    Forwards job watch events to the queue until `stop` is set, run in a
+    daemon thread. Each streaming response is appended to `responses` so
+    the caller can shut it down once done.
+    """
+    try:
+        for event in client.watch('/apis/batch/v1/namespaces/{}/jobs',
+                                  namespace,
+                                  params={'labelSelector': selector},
+                                  stop=stop, on_response=responses.append):
+            if stop.is_set():
+                break
+            events.put(event)
+    except Exception as e:
+        if not stop.is_set():
+            events.put(('ERROR', e))
+
+
+def handle_job_event(namespace, pending, results, event_type, obj):
+    """
+    :return: False if the watch failed
+    """
+    if event_type == 'ERROR':
+        print('Watching jobs failed, falling back to polling every %.1fs: '
+              '%r' % (RETRY_DELAY, obj), file=sys.stderr)
+        return False
+
+    name = obj.metadata.name
+    if name not in pending:
+        return True
+
+    version = obj.metadata.get('resourceVersion')
+    if event_type == 'ADDED' and \
+            version == pending[name]['job'].metadata.get('resourceVersion'):
+        # the watch starts by sending every existing job, those we already
+        # have are unchanged
+        return True
+
+    if event_type == 'DELETED':
+        print('Job was deleted: %s/%s' % (namespace, name))
+        results['deleted elsewhere'] += 1
+        del pending[name]
     else:
-        print('Failed to delete job %s/%s: %r (%d attempts '
-              'remaining)' % (namespace, job.metadata.name, ret, retries),
-              file=sys.stderr)
+        pending[name]['job'] = obj
+        pending[name]['next_attempt'] = time.time()
+
+    return True
+
+
+def refresh_jobs(client, namespace, selector, pending, results):
+    """
+    Refreshes all pending jobs with a single list call, joined by name.
+    Jobs missing from the listing were deleted by someone else.
+    """
+    current = {}
+    for job in client.list_iter('/apis/batch/v1/namespaces/{}/jobs',
+                                namespace, label_selector=selector):
+        current[job.metadata.name] = job
+
+    now = time.time()
+    for name in list(pending):
+        if name not in current:
+            print('Job was deleted: %s/%s' % (namespace, name))
+            results['deleted elsewhere'] += 1
+            del pending[name]
+        elif pending[name]['next_attempt'] is None:
+            pending[name]['job'] = current[name]
+            pending[name]['next_attempt'] = now
+
+
+def delete_jobs_when_complete(client, namespace, selector, jobs, pool,
+                              results, job_pods=None,
+                              deletable=is_job_complete):
+    """
+    Deletes each job as soon as it completes, reacting to watch events
+    rather than polling. If the watch fails, all pending jobs are refreshed
+    with one list call every RETRY_DELAY instead. A job whose delete fails
+    is retried after RETRY_DELAY, and each job is given up on JOB_DEADLINE
+    seconds after cleanup started. Jobs that become deletable together are
+    deleted concurrently using `pool`.
+
+    :param selector: label selector covering all jobs, or None to watch the
+                     whole namespace
+    :param job_pods: pod names by job name if pods were already listed
+    :param deletable: predicate telling whether a job may be deleted, by
+                      default whether it completed
+    :type results: collections.Counter
+    :return: the jobs that were not deleted before their deadline
+    """
+    now = time.time()
+    pending = {}
+    for job in jobs:
+        pending[job.metadata.name] = {'job': job,
+                                      'deadline': now + JOB_DEADLINE,
+                                      'next_attempt': now}
+
+    events = Queue()
+    stop = threading.Event()
+    responses = []
+    watcher = threading.Thread(target=watch_jobs,
+                               args=(client, namespace, selector, events,
+                                     stop, responses))
+    watcher.daemon = True
+    watcher.start()
+    try:
+        return process_pending_jobs(client, namespace, selector, pending,
+                                    events, pool, results, job_pods,
+                                    deletable)
+    finally:
+        stop.set()
+        for res in list(responses):
+            shutdown_response(res)
+        watcher.join(WATCH_JOIN_TIMEOUT)
+
+
+def process_pending_jobs(client, namespace, selector, pending, events, pool,
+                         results, job_pods, deletable):
+    """
+    The loop of delete_jobs_when_complete(), fed by the watch events queue.
+
+    :param pending: state of each job not yet deleted, by name
+    :return: the jobs that were not deleted before their deadline
+    """
+    failed = []
+    polling = False
+    while pending:
+        now = time.time()
+        if polling:
+            refresh_jobs(client, namespace, selector, pending, results)
+
+        due = [name for name, state in pending.items()
+               if state['next_attempt'] is not None
+               and state['next_attempt'] <= now]
+        due_jobs = [pending[name]['job'] for name in due]
+        if job_pods is not None:
+            delete_pods_of_jobs(client, namespace,
+                                [job for job in due_jobs
+                                 if deletable(job)], job_pods)
+        deleted = pool.map(
+            lambda job: try_delete_job(client, namespace, job,
+                                       pods=pods_of(job_pods, job),
+                                       deletable=deletable),
+            due_jobs)
+
+        now = time.time()
+        for name, job, success in zip(due, due_jobs, deleted):
+            if success:
+                results['deleted'] += 1
+                del pending[name]
+            elif deletable(job):
+                # failed deletes are retried on their own schedule
+                pending[name]['next_attempt'] = now + RETRY_DELAY
+            else:
+                # incomplete jobs wait for a watch event
+                pending[name]['next_attempt'] = None
+
+        for name, state in list(pending.items()):
+            if state['deadline'] <= now:
+                print('Job did not finish in time: %s/%s' % (namespace, name),
+                      file=sys.stderr)
+                failed.append(state['job'])
+                del pending[name]
+
+        if not pending:
+            break
+
+        wake = min(min(s['deadline'], s['next_attempt'] or s['deadline'])
+                   for s in pending.values())
+        if polling:
+            time.sleep(max(0.0, min(wake, now + RETRY_DELAY) - time.time()))
+            continue
+
+        try:
+            event = events.get(timeout=max(0.0, wake - time.time()))
+        except Empty:
+            continue
+
+        # handle everything that arrived meanwhile, so jobs that completed
+        # together are deleted together
+        while event is not None:
+            if not handle_job_event(namespace, pending, results, *event):
+                polling = True
+            try:
+                event = events.get_nowait()
+            except Empty:
+                event = None
+
+    return failed
+
+
+def pods_of(job_pods, job):
+    if job_pods is None:
+        return None
+
+    return job_pods.get(job.metadata.name, [])
+
 
-        return False, retries - 1
+def find_jobs(client, namespace, selectors, exclude=None):
+    """
+    Finds the jobs matching any of the selectors from a single streamed
+    listing of the namespace's jobs, then lists the job pods once and groups
+    them by job.
+
+    :param selectors: label selectors, or None for all jobs
+    :param exclude: name of a job to leave alone, i.e. our own
+    :return: (jobs, dict of job name -> names of its non-defunct pods)
+    """
+    jobs = []
+    for job in client.list_iter('/apis/batch/v1/namespaces/{}/jobs',
+                                namespace):
+        if job.metadata.name == exclude:
+            continue
+
+        labels = job.metadata.get('labels') or {}
+        if selectors is None or any(selector_matches(s, labels)
+                                    for s in selectors):
+            jobs.append(job)
+
+    job_pods = defaultdict(list)
+    if not jobs:
+        return jobs, job_pods
+
+    names = set(job.metadata.name for job in jobs)
+    for pod in client.list_iter('/api/v1/namespaces/{}/pods', namespace,
+                                label_selector='job-name,defunct!=true',
+                                raw=True):
+        job_name = pod['metadata']['labels']['job-name']
+        if job_name in names:
+            job_pods[job_name].append(pod['metadata']['name'])
+
+    return jobs, job_pods
+
+
+def report_defunct_pods(client, namespace, jobs):
+    """
+    Prints how many pods of each job are labelled `defunct=true`. Pod deletes
+    skip them, but the odd state is worth surfacing.
+    """
+    names = set(job.metadata.name for job in jobs)
+    defunct = Counter()
+    for pod in client.list_iter('/api/v1/namespaces/{}/pods', namespace,
+                                label_selector='job-name,defunct=true',
+                                raw=True):
+        job_name = pod['metadata']['labels']['job-name']
+        if job_name in names:
+            defunct[job_name] += 1
+
+    for job_name, count in sorted(defunct.items()):
+        print('Job %s/%s has %d pods marked as defunct, they will not be '
+              'deleted' % (namespace, job_name, count))
 
 
 def label_defunct(client, namespace, job):
     job_name = job.metadata.name
-    pods = client.get('/api/v1/namespaces/{}/pods', namespace,
-                      params={'labelSelector': 'job-name=%s' % job_name})
+    pods = client.list_iter('/api/v1/namespaces/{}/pods', namespace,
+                            label_selector='job-name=%s' % job_name)
 
     defunct_ops = [{
         'op': 'add',
@@ -130,7 +536,7 @@ def label_defunct(client, namespace, job):
         'value': 'true'
     }]
 
-    for pod in pods['items']:
+    for pod in pods:
         r = client.json_patch(defunct_ops,
                               '/api/v1/namespaces/{}/pods/{}',
                               namespace, pod.metadata.name,
@@ -143,79 +549,146 @@ def label_defunct(client, namespace, job):
 
 
 def main():
-    client = KubernetesAPIClient()
-    if USE_KUBE_CONFIG:
-        client.load_kube_config()
-    else:
-        client.load_cluster_config()
+    start = time.time()
+    stats = ApiCallStats()
+    try:
+        cleanup(stats)
+    finally:
+        stats.report(time.time() - start)
+
+
+def cleanup(stats, client=None):
+    if client is None:
+        client = KubernetesAPIClient()
+        if USE_KUBE_CONFIG:
+            client.load_kube_config()
+        else:
+            client.load_cluster_config()
+
+    client.observer = stats.record
 
     namespace = get_current_namespace()
     pod_name = get_current_pod()
 
-    pod = client.get('/api/v1/namespaces/{}/pods/{}', namespace, pod_name)
+    # the reference pod is only needed for its labels, or to delete
+    # ourselves when done
+    pod = None
+    if pod_is_self or not (ALL_JOBS or SELECTORS):
+        pod = client.get('/api/v1/namespaces/{}/pods/{}', namespace,
+                         pod_name)
+
+    job_pods = None
+    if ALL_JOBS or SELECTORS:
+        this_job = None
+        if pod_is_self:
+            this_job = pod.metadata.labels.get('job-name', None)
+
+        if ALL_JOBS:
+            print('Cleaning up all jobs in namespace %s' % namespace)
+            selectors = None
+            selector = None
+        else:
+            print('Cleaning up jobs in namespace %s matching any of: %s' % (
+                namespace, '; '.join(SELECTORS)))
+            selectors = SELECTORS
+            selector = SELECTORS[0] if len(SELECTORS) == 1 else None
+
+        jobs, job_pods = find_jobs(client, namespace, selectors,
+                                   exclude=this_job)
+        if ALL_JOBS:
+            # jobs of other releases may still be doing their work, so only
+            # those that already completed or failed are cleaned up
+            for job in jobs:
+                if not is_job_finished(job):
+                    print('Leaving running job alone: %s/%s' % (
+                        namespace, job.metadata.name))
+            jobs = [job for job in jobs if is_job_finished(job)]
+
+        if not jobs:
+            print('No jobs to clean up!')
+            sys.exit(0)
+
+        for job in jobs:
+            print(' - %s/%s (%d pods)' % (namespace, job.metadata.name,
+                                          len(job_pods[job.metadata.name])))
+    else:
+        app = pod.metadata.labels['app']
+        component = pod.metadata.labels.get('component', None)
+        this_job = pod.metadata.labels.get('job-name', None)
 
-    app = pod.metadata.labels['app']
-    component = pod.metadata.labels.get('component', None)
-    this_job = pod.metadata.labels.get('job-name', None)
+        if pod_is_self and this_job:
+            selector = 'app={},component!={}'.format(app, component)
+        else:
+            selector = 'app={}'.format(app)
 
-    if pod_is_self and this_job:
-        selector = 'app={},component!={}'.format(app, component)
-    else:
-        selector = 'app={}'.format(app)
+        jobs = list(client.list_iter('/apis/batch/v1/namespaces/{}/jobs',
+                                     namespace, label_selector=selector))
+        if not jobs:
+            print('No jobs to clean up!')
+            sys.exit(0)
 
-    jobs = client.get('/apis/batch/v1/namespaces/{}/jobs', namespace,
-                      params={'labelSelector': selector})
+        for job in jobs:
+            job.pprint()
 
-    items = [(item, RETRIES) for item in jobs['items']]
-    if not items:
-        print('No jobs to clean up!')
-        sys.exit(0)
+    report_defunct_pods(client, namespace, jobs)
 
-    for job, retries in items:
-        job.pprint()
+    print('Removing %d jobs using %d workers...' % (len(jobs), WORKERS))
+    results = Counter()
+    pool = ThreadPool(WORKERS)
+    try:
+        failed = delete_jobs_when_complete(
+            client, namespace, selector, jobs, pool, results, job_pods,
+            deletable=is_job_finished if ALL_JOBS else is_job_complete)
 
-    failed = []
-    while items:
-        print('Removing %d jobs...' % len(items))
-        remaining = []
-        for job, retries in items:
-            success, retries = try_delete_job(client, namespace, job, retries)
-            if not success:
-                if retries is 0:
-                    failed.append(job)
-                else:
-                    remaining.append((job, retries))
-
-        if remaining:
-            print('Still waiting on some jobs to be removed...')
-            time.sleep(RETRY_DELAY)
-
-        items = []
-        for job, retries in remaining:
-            refreshed_job = client.get('/apis/batch/v1/namespaces/{}/jobs/{}',
-                                       namespace, job.metadata.name)
-            items.append((refreshed_job, retries))
-
-    if failed:
-        print('Some jobs did not finish in time, they will be killed!',
-              file=sys.stderr)
         still_failed = []
-        for job in failed:
-            print('Killing job: %s/%s' % (namespace, job.metadata.name))
-            success, _ = try_delete_job(client, namespace, job, 0, force=True)
-            if not success:
-                still_failed.append(job)
-
-        if still_failed:
-            print('Not all jobs could be killed!', file=sys.stderr)
-            print('These jobs will be annotated with `defunct=true` and will '
-                  'be ignored by future cleanup jobs. They will need to be '
-                  'removed manually.', file=sys.stderr)
-            for job in still_failed:
-                print(' - %s/%s' % (namespace, job.metadata.name))
-                label_defunct(client, namespace, job)
-
-            sys.exit(1)
+        if failed and ALL_JOBS:
+            # nothing is ever killed in this mode, whatever is left stays
+            print('Some jobs could not be deleted in time, leaving them in '
+                  'place:', file=sys.stderr)
+            for job in failed:
+                print(' - %s/%s' % (namespace, job.metadata.name),
+                      file=sys.stderr)
+            results['not deleted'] = len(failed)
+        elif failed:
+            print('Some jobs did not finish in time, they will be killed!',
+                  file=sys.stderr)
+            for job in failed:
+                print('Killing job: %s/%s' % (namespace, job.metadata.name))
+
+            if job_pods is not None:
+                delete_pods_of_jobs(client, namespace, failed, job_pods,
+                                    force=True)
+
+            killed = pool.map(
+                lambda job: try_delete_job(client, namespace, job,
+                                           force=True,
+                                           pods=pods_of(job_pods, job)),
+                failed)
+            results['killed'] += sum(killed)
+            still_failed = [job for job, ok in zip(failed, killed) if not ok]
+    finally:
+        pool.close()
+
+    results['defunct'] = len(still_failed)
+    keys = ['deleted', 'deleted elsewhere', 'killed', 'defunct']
+    if ALL_JOBS:
+        keys.append('not deleted')
+    print('Cleanup summary: %s' % ', '.join(
+        '%d %s' % (results[key], key) for key in keys))
+
+    if results['not deleted']:
+        sys.exit(1)
+
+    if still_failed:
+        print('Not all jobs could be killed!', file=sys.stderr)
+        print('These jobs will be annotated with `defunct=true` and will '
+              'be ignored by future cleanup jobs. They will need to be '
+              'removed manually.', file=sys.stderr)
+        for job in still_failed:
+            print(' - %s/%s' % (namespace, job.metadata.name))
+            label_defunct(client, namespace, job)
+
+        sys.exit(1)
 
     if pod_is_self:
         print('All jobs deleted, removing cleanup job...')
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Client-side evaluation of Kubernetes label selectors. Also used by the fake
+Kubernetes API in tools/fakes, so both agree on what a selector matches.
+"""
+
+import re
+
+SET_TERM = re.compile(r'^(\S+)\s+(in|notin)\s+\((.*)\)$')
+
+
+def split_selector(selector):
+    """Splits a label selector into terms, keeping sets like `a in (b,c)`"""
+    terms = []
+    depth = 0
+    start = 0
+    selector = selector or ''
+    for i, char in enumerate(selector):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            terms.append(selector[start:i])
+            start = i + 1
+    terms.append(selector[start:])
+    return [term.strip() for term in terms if term.strip()]
+
+
+def selector_matches(selector, labels):
+    """
+    Evaluates a label selector the way the API server does, supporting
+    `key=value`, `key==value`, `key!=value`, `key`, `!key`,
+    `key in (a,b)` and `key notin (a,b)` terms.
+
+    :param labels: labels of an object, may be None
+    """
+    labels = labels or {}
+    for term in split_selector(selector):
+        set_term = SET_TERM.match(term)
+        if set_term:
+            key, op, values = set_term.groups()
+            values = set(v.strip() for v in values.split(','))
+            if (labels.get(key) in values) != (op == 'in'):
+                return False
+        elif '!=' in term:
+            key, value = term.split('!=', 1)
+            if labels.get(key.strip()) == value.strip():
+                return False
+        elif '=' in term:
+            key, value = term.replace('==', '=').split('=', 1)
+            if labels.get(key.strip()) != value.strip():
+                return False
+        elif term.startswith('!'):
+            if term[1:].strip() in labels:
+                return False
+        elif term not in labels:
+            return False
+
+    return True
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Compares the cost of wrapping a decoded list response as a DotMap (the old
+KubernetesAPIResponse), as a lazy KubernetesAPIResponse, and of using the
+raw dict, both for wrapping alone and for reading each item's name and
+labels the way cleanup.py does.
+"""
+
+from __future__ import print_function
+
+import argparse
+import copy
+import timeit
+
+from dotmap import DotMap
+
+from kubernetes import KubernetesAPIResponse
+
+
+def make_pod_list(count):
+    return {
+        'kind': 'PodList',
+        'apiVersion': 'v1',
+        'metadata': {'resourceVersion': '1'},
+        'items': [{
+            'metadata': {
+                'name': 'pod-{:d}'.format(i),
+                'namespace': 'default',
+                'labels': {'app': 'example', 'job-name': 'job-{:d}'.format(i)},
+                'annotations': {'example.com/index': str(i)},
+            },
+            'spec': {
+                'containers': [{
+                    'name': 'main',
+                    'image': 'example:latest',
+                    'env': [{'name': 'VAR_{:d}'.format(n), 'value': str(n)}
+                            for n in range(10)],
+                }],
+            },
+            'status': {
+                'phase': 'Succeeded',
+                'conditions': [{'type': 'Ready', 'status': 'False'}],
+            },
+        } for i in range(count)],
+    }
+
+
+def read_dotmap(response):
+    for item in response['items']:
+        item.metadata.name
+        item.metadata.labels.get('defunct')
+
+
+def read_lazy(response):
+    for item in response['items']:
+        item.metadata.name
+        item.metadata.labels.get('defunct')
+
+
+def read_raw(response):
+    for item in response['items']:
+        item['metadata']['name']
+        item['metadata']['labels'].get('defunct')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--items', type=int, default=10000,
+                        help='Items in each list response')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs of each case, the best is reported')
+    args = parser.parse_args()
+
+    body = make_pod_list(args.items)
+    # json decoding produces a fresh structure for every response
+    bodies = [copy.deepcopy(body) for _ in range(args.repeat)]
+
+    cases = [
+        ('dotmap', lambda b: DotMap(b, _dynamic=False), read_dotmap),
+        ('lazy', lambda b: KubernetesAPIResponse(None, b), read_lazy),
+        ('raw', lambda b: b, read_raw),
+    ]
+
+    print('{:>8} {:>12} {:>15}'.format('wrapper', 'wrap (ms)',
+                                       'wrap+read (ms)'))
+    for name, wrap, read in cases:
+        it = iter(bodies)
+        wrap_time = min(timeit.repeat(lambda: wrap(next(it)),
+                                      number=1, repeat=args.repeat))
+        it = iter(bodies)
+        total = min(timeit.repeat(lambda: read(wrap(next(it))),
+                                  number=1, repeat=args.repeat))
+        print('{:>8} {:>12.1f} {:>15.1f}'.format(name, wrap_time * 1000,
+                                                 total * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -16,15 +16,19 @@
 # under the License.
 
 import base64
+import hashlib
+import json
 import logging
 import os
 import random
+import re
 import string
-import time
+import threading
 
 from collections import defaultdict
-from itertools import ifilter
+from multiprocessing.pool import ThreadPool
 
+import requests
 import yaml
 
 from keystoneauth1.exceptions import NotFound
@@ -32,8 +36,13 @@ from keystoneauth1.exceptions import RetriableConnectionFailure
 from keystoneauth1.identity import Password
 from keystoneauth1.session import Session
 from keystoneclient.discover import Discover
+from keystoneclient.v3 import client as v3_client
 from requests import HTTPError
 from requests import RequestException
+from requests.adapters import HTTPAdapter
+
+import api_metrics
+import retry_policy
 
 from kubernetes import KubernetesAPIClient
 from kubernetes import KubernetesAPIResponse
@@ -49,8 +58,28 @@ KEYSTONE_TIMEOUT = int(os.environ.get('KEYSTONE_TIMEOUT', '10'))
 KEYSTONE_VERIFY = os.environ.get('KEYSTONE_VERIFY', 'true') == 'true'
 KEYSTONE_CERT = os.environ.get('KEYSTONE_CERT', None)
 
+# pinning the identity API version (only '3' is supported) skips version
+# discovery; with an endpoint as well, the service catalog isn't consulted
+KEYSTONE_API_VERSION = os.environ.get('KEYSTONE_API_VERSION', None)
+KEYSTONE_ENDPOINT = os.environ.get('KEYSTONE_ENDPOINT', None)
+KEYSTONE_POOL_SIZE = int(os.environ.get('KEYSTONE_POOL_SIZE', '10'))
+VERSIONED_URL_PATTERN = re.compile(r'/v\d+(\.\d+)?$')
+
 PRELOAD_PATH = os.environ.get('PRELOAD_PATH', '/preload.yml')
 NAMESPACE_FILE = '/var/run/secrets/kubernetes.io/serviceaccount/namespace'
+SECRET_LIST = os.environ.get('SECRET_LIST', 'false').lower() == 'true'
+SECRET_LIST_LIMIT = int(os.environ.get('SECRET_LIST_LIMIT', '500'))
+
+# where to persist the state of the last successful run, if anywhere
+STATE_CONFIGMAP = os.environ.get('STATE_CONFIGMAP', None)
+STATE_FILE = os.environ.get('STATE_FILE', None)
+STATE_CONFIGMAP_KEY = 'state.json'
+
+# number of domains, and of users within a domain, reconciled in parallel
+WORKERS = int(os.environ.get('KEYSTONE_INIT_WORKERS', '1'))
+
+# delete endpoints of preloaded services that the preload no longer lists
+PRUNE_ENDPOINTS = os.environ.get('PRUNE_ENDPOINTS', 'false').lower() == 'true'
 
 LOG_LEVEL = logging.getLevelName(os.environ.get('LOG_LEVEL', 'INFO'))
 logging.basicConfig(level=LOG_LEVEL)
@@ -58,49 +87,294 @@ logger = logging.getLogger(__name__)
 
 DEFAULT_MEMBER_ROLE = '_member_'
 
-_domain_cache = []
-_global_role_cache = []
-_project_cache = defaultdict(lambda: [])
-_role_cache = defaultdict(lambda: [])
-_group_cache = defaultdict(lambda: [])
-_service_cache = []
-_endpoint_cache = []
+# keystoneclient managers and methods timed when API_METRICS is enabled
+INSTRUMENTED_MANAGERS = [
+    'domains', 'projects', 'roles', 'groups', 'users', 'services',
+    'endpoints', 'role_assignments'
+]
+INSTRUMENTED_METHODS = [
+    'list', 'get', 'create', 'update', 'delete', 'grant', 'check_in_group',
+    'add_to_group'
+]
 
 _kubernetes_client = None
+_kubernetes_client_lock = threading.Lock()
+_keystone_session = None
+_keystone_session_lock = threading.Lock()
 
 
-def first(condition, seq):
-    try:
-        return next(ifilter(condition, seq))
-    except StopIteration:
-        return None
+def endpoint_key(endpoint):
+    """
+    :type endpoint: keystoneclient.v3.endpoints.Endpoint
+    :return: (service_id, interface, region)
+    """
+    region = getattr(endpoint, 'region_id', None) or \
+        getattr(endpoint, 'region', None)
+    return endpoint.service_id, endpoint.interface, region
+
+
+class KeyedCache(object):
+    """
+    Keystone resources indexed both by id and by a lookup key (the resource
+    name by default). Entries are updated in place as resources are created
+    or modified, so lookups stay O(1) no matter how many resources exist.
+
+    All methods are thread-safe.
+    """
+
+    def __init__(self, key=lambda r: r.name):
+        self._key = key
+        self._by_key = {}
+        self._by_id = {}
+        self._lock = threading.RLock()
+        self._create_locks = {}
+        self.loaded = False
+
+    def ensure_loaded(self, loader):
+        """
+        Populates the cache from `loader()` the first time it is called.
+
+        :param loader: callable returning a list of resources
+        """
+        with self._lock:
+            if not self.loaded:
+                for resource in loader():
+                    self.add(resource)
+                self.loaded = True
+
+    def find(self, key):
+        with self._lock:
+            return self._by_key.get(key)
+
+    def get(self, resource_id):
+        with self._lock:
+            return self._by_id.get(resource_id)
+
+    def find_or_create(self, key, create):
+        """
+        Returns the resource for `key`, calling `create()` if it does not
+        exist yet. Concurrent calls for the same key only create it once.
+
+        :return: (resource, created)
+        """
+        with self._lock:
+            resource = self._by_key.get(key)
+            if resource is not None:
+                return resource, False
+
+            create_lock = self._create_locks.setdefault(key, threading.Lock())
+
+        with create_lock:
+            resource = self.find(key)
+            if resource is not None:
+                return resource, False
+
+            resource = create()
+            self.add(resource)
+            return resource, True
+
+    def add(self, resource):
+        """Adds a resource, replacing any existing entry with the same id."""
+        with self._lock:
+            existing = self._by_id.get(resource.id)
+            if existing is not None:
+                self._by_key.pop(self._key(existing), None)
+
+            self._by_id[resource.id] = resource
+            self._by_key[self._key(resource)] = resource
+
+    def remove(self, resource):
+        with self._lock:
+            existing = self._by_id.pop(resource.id, None)
+            if existing is not None:
+                self._by_key.pop(self._key(existing), None)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._by_id.values()))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._by_id)
+
+
+class KeyedCacheMap(dict):
+    """A KeyedCache per domain id, created on first access."""
+
+    def __init__(self):
+        super(KeyedCacheMap, self).__init__()
+        self._lock = threading.Lock()
+
+    def __missing__(self, key):
+        with self._lock:
+            return self.setdefault(key, KeyedCache())
+
+
+class RoleAssignmentIndex(object):
+    """
+    Role ids granted directly to users, indexed by (user id, project id).
+    Assignments are loaded one scope at a time: a project's assignments with
+    a single listing shared by all of its users, or all of one user's
+    assignments, which are also indexed under (user id, None) to mirror an
+    unscoped `role_assignments.list(user=...)` call.
+
+    Listings are made under a per-scope lock only, so different scopes are
+    loaded concurrently while no scope is listed twice.
+    """
+
+    def __init__(self):
+        self._role_ids = defaultdict(set)
+        self._loaded = set()
+        self._scope_locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def ensure_loaded(self, scope, loader):
+        """
+        :param scope: hashable key of what `loader` lists, e.g.
+                      ('project', project id)
+        :param loader: callable returning a list of role assignments
+        """
+        with self._lock:
+            scope_lock = self._scope_locks[scope]
+
+        with scope_lock:
+            with self._lock:
+                if scope in self._loaded:
+                    return
+
+            for assignment in loader():
+                # group assignments are not returned by a per-user listing
+                # either, so skip them here too
+                if not hasattr(assignment, 'user'):
+                    continue
+
+                project = assignment.scope.get('project', {}).get('id')
+                self.add(assignment.user['id'], project,
+                         assignment.role['id'])
+
+            with self._lock:
+                self._loaded.add(scope)
+
+    def role_ids(self, user_id, project_id):
+        with self._lock:
+            return set(self._role_ids.get((user_id, project_id), ()))
+
+    def add(self, user_id, project_id, role_id):
+        with self._lock:
+            self._role_ids[(user_id, None)].add(role_id)
+            if project_id is not None:
+                self._role_ids[(user_id, project_id)].add(role_id)
+
+
+_domain_cache = KeyedCache()
+_global_role_cache = KeyedCache()
+_project_cache = KeyedCacheMap()
+_role_cache = KeyedCacheMap()
+_group_cache = KeyedCacheMap()
+_service_cache = KeyedCache()
+_user_cache = KeyedCacheMap()
+_role_assignments = RoleAssignmentIndex()
+
+
+class SecretCache(object):
+    """
+    Kubernetes secrets indexed by (namespace, name), updated as secrets are
+    written so every later read is served from memory. Secrets are read one
+    by one unless SECRET_LIST is set, in which case each namespace is listed
+    once, on first access; a namespace the job may not list falls back to
+    reading secrets one by one. Namespaces known to exist are remembered too.
+
+    Network calls are made under a per-namespace lock only, so namespaces
+    are read concurrently while one namespace is never listed twice.
+    """
+
+    def __init__(self, list_namespaces=None):
+        if list_namespaces is None:
+            list_namespaces = SECRET_LIST
+
+        self._list_namespaces = list_namespaces
+        self._secrets = {}
+        self._listed = {}
+        self._namespaces = set()
+        self._namespace_locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def _namespace_lock(self, namespace):
+        with self._lock:
+            return self._namespace_locks[namespace]
+
+    def _list(self, client, namespace):
+        with self._namespace_lock(namespace):
+            with self._lock:
+                if namespace in self._listed:
+                    return
+
+            secrets = list_kubernetes_secrets(client, namespace)
+            with self._lock:
+                self._listed[namespace] = secrets is not None
+                if secrets is None:
+                    logger.warning('not allowed to list secrets in namespace '
+                                   '"%s", reading them one by one', namespace)
+                    return
+
+                for secret in secrets:
+                    key = (namespace, secret.metadata.name)
+                    self._secrets.setdefault(key, secret)
+
+                # an empty list doesn't prove the namespace exists, the API
+                # returns one for unknown namespaces too
+                if secrets:
+                    self._namespaces.add(namespace)
+
+    def get(self, client, namespace, name):
+        key = (namespace, name)
+        if self._list_namespaces:
+            self._list(client, namespace)
+
+        with self._lock:
+            if key in self._secrets or self._listed.get(namespace):
+                return self._secrets.get(key)
+
+        secret = read_kubernetes_secret(client, namespace, name)
+        with self._lock:
+            if secret is not None:
+                self._namespaces.add(namespace)
+
+            return self._secrets.setdefault(key, secret)
+
+    def put(self, namespace, name, secret):
+        with self._lock:
+            self._secrets[(namespace, name)] = secret
+            self._namespaces.add(namespace)
+
+    def ensure_namespace(self, client, namespace):
+        with self._namespace_lock(namespace):
+            with self._lock:
+                if namespace in self._namespaces:
+                    return
+
+            ensure_kubernetes_namespace(client, namespace)
+            with self._lock:
+                self._namespaces.add(namespace)
+
+
+_secret_cache = SecretCache()
 
 
 class KeystoneInitException(Exception):
     pass
 
 
+def log_response(exc):
+    response = getattr(exc, 'response', None)
+    if isinstance(exc, RequestException) and response is not None:
+        logger.debug('Response was: %r', response.text)
+
+
 def retry(retries=5, delay=2.0,
           exc_types=(RetriableConnectionFailure, RequestException)):
-
-    def decorator(func):
-        def f_retry(*args, **kwargs):
-            for i in range(retries):
-                try:
-                    return func(*args, **kwargs)
-                except exc_types as exc:
-                    if i < retries - 1:
-                        logger.debug('Caught exception, retrying...',
-                                     exc_info=True)
-                        time.sleep(delay)
-                    else:
-                        logger.exception('Failed after %d attempts', retries)
-                        if isinstance(exc, RequestException):
-                            logger.debug('Response was: %r', exc.response.text)
-
-                        raise
-        return f_retry
-    return decorator
+    return retry_policy.retry(retries=retries, delay=delay,
+                              exc_types=exc_types, on_failure=log_response)
 
 
 def get_current_namespace():
@@ -119,9 +393,13 @@ def get_current_namespace():
 def get_kubernetes_client():
     global _kubernetes_client
 
-    if _kubernetes_client is None:
-        _kubernetes_client = KubernetesAPIClient()
-        _kubernetes_client.load_auto_config()
+    with _kubernetes_client_lock:
+        if _kubernetes_client is None:
+            client = KubernetesAPIClient()
+            client.load_auto_config()
+            if api_metrics.ENABLED:
+                client.observer = api_metrics.record
+            _kubernetes_client = client
 
     return _kubernetes_client
 
@@ -139,18 +417,83 @@ def keystone_args_from_env():
     return ret
 
 
+def versioned_url(url):
+    """
+    Appends the identity API version to a URL that doesn't end in one, e.g.
+    `http://keystone:5000` becomes `http://keystone:5000/v3`.
+
+    :type url: str
+    :rtype: str
+    """
+    url = url.rstrip('/')
+    if VERSIONED_URL_PATTERN.search(url):
+        return url
+
+    return url + '/v3'
+
+
+def get_keystone_session():
+    """
+    Returns the job-wide Keystone session, created on first use. All clients
+    share its token and its pool of HTTP connections.
+
+    :rtype: keystoneauth1.session.Session
+    """
+    global _keystone_session
+
+    with _keystone_session_lock:
+        if _keystone_session is None:
+            # load_domains() runs a domain pool and a shared user pool of
+            # WORKERS threads each, so at most 2 * WORKERS requests are in
+            # flight at once
+            pool_size = max(KEYSTONE_POOL_SIZE, 2 * WORKERS)
+            http = requests.Session()
+            for prefix in ('http://', 'https://'):
+                http.mount(prefix, HTTPAdapter(pool_connections=pool_size,
+                                               pool_maxsize=pool_size))
+
+            auth = Password(**keystone_args_from_env())
+            _keystone_session = Session(auth=auth,
+                                        session=http,
+                                        app_name='keystone-init',
+                                        user_agent='keystone-init',
+                                        timeout=KEYSTONE_TIMEOUT,
+                                        verify=KEYSTONE_VERIFY,
+                                        cert=KEYSTONE_CERT)
+
+    return _keystone_session
+
+
 @retry(retries=24, delay=5)
 def get_keystone_client():
-    auth = Password(**keystone_args_from_env())
-    session = Session(auth=auth,
-                      app_name='keystone-init',
-                      user_agent='keystone-init',
-                      timeout=KEYSTONE_TIMEOUT,
-                      verify=KEYSTONE_VERIFY,
-                      cert=KEYSTONE_CERT)
+    session = get_keystone_session()
+
+    if KEYSTONE_API_VERSION is None:
+        kwargs = {}
+        if KEYSTONE_ENDPOINT:
+            kwargs['endpoint_override'] = KEYSTONE_ENDPOINT
+
+        client = Discover(session=session).create_client(**kwargs)
+    elif KEYSTONE_API_VERSION.lstrip('v') in ('3', '3.0'):
+        # authenticate now so failures are retried here rather than on the
+        # first API call
+        session.get_token()
+        # without discovery, talk to the URL we authenticated against unless
+        # told otherwise; the client needs it to include the version
+        endpoint = KEYSTONE_ENDPOINT or keystone_args_from_env()['auth_url']
+        client = v3_client.Client(session=session,
+                                  endpoint_override=versioned_url(endpoint))
+    else:
+        raise KeystoneInitException(
+            'unsupported KEYSTONE_API_VERSION: {}'.format(
+                KEYSTONE_API_VERSION))
 
-    discover = Discover(session=session)
-    return discover.create_client()
+    for name in INSTRUMENTED_MANAGERS:
+        api_metrics.instrument_methods(getattr(client, name),
+                                       'keystone.{}'.format(name),
+                                       INSTRUMENTED_METHODS)
+
+    return client
 
 
 @retry()
@@ -167,17 +510,17 @@ def get_or_create_domain(client, name=None):
     if name is None:
         return client.domains.get('default')
 
-    if not _domain_cache:
-        _domain_cache.extend(client.domains.list())
+    _domain_cache.ensure_loaded(client.domains.list)
 
-    domain = first(lambda d: d.name == name, _domain_cache)
-    if domain:
-        logger.info('found existing domain: %s', domain.name)
-    else:
+    def create():
         logger.info('creating domain: %s', name)
-        domain = client.domains.create(name)
-        _domain_cache.append(domain)
+        return client.domains.create(name)
+
+    domain, created = _domain_cache.find_or_create(name, create)
+    if created:
         logger.debug('created domain: %s', domain.name)
+    else:
+        logger.info('found existing domain: %s', domain.name)
 
     return domain
 
@@ -216,17 +559,17 @@ def get_or_create_project(client, domain, name):
     """
 
     cache = _project_cache[domain.id]
-    if not cache:
-        cache.extend(client.projects.list(domain=domain))
+    cache.ensure_loaded(lambda: client.projects.list(domain=domain))
 
-    project = first(lambda p: p.name == name, cache)
-    if project:
-        logger.info('found existing project: %s', project.name)
-    else:
+    def create():
         logger.info('creating project: %s', name)
-        project = client.projects.create(name, domain)
-        cache.append(project)
+        return client.projects.create(name, domain)
+
+    project, created = cache.find_or_create(name, create)
+    if created:
         logger.debug('created project: %r', project)
+    else:
+        logger.info('found existing project: %s', project.name)
 
     return project
 
@@ -239,17 +582,17 @@ def get_or_create_global_role(client, name):
     :type name: str
     :rtype: keystoneclient.v3.roles.Role
     """
-    if not _global_role_cache:
-        _global_role_cache.extend(client.roles.list())
+    _global_role_cache.ensure_loaded(client.roles.list)
 
-    role = first(lambda r: r.name == name, _global_role_cache)
-    if role:
-        logger.info('found existing global role: %s', role.name)
-    else:
+    def create():
         logger.info('creating new global role: %s', name)
-        role = client.roles.create(name)
-        _global_role_cache.append(role)
+        return client.roles.create(name)
+
+    role, created = _global_role_cache.find_or_create(name, create)
+    if created:
         logger.debug('created new global role: %r', role)
+    else:
+        logger.info('found existing global role: %s', role.name)
 
     return role
 
@@ -267,31 +610,30 @@ def get_or_create_role(client, domain, name):
     :return:
     :rtype: keystoneclient.v3.roles.Role
     """
-    if not _global_role_cache:
-        _global_role_cache.extend(client.roles.list())
+    _global_role_cache.ensure_loaded(client.roles.list)
 
-    global_role = first(lambda r: r.name == name, _global_role_cache)
+    global_role = _global_role_cache.find(name)
     if global_role:
         logger.info('found existing global role: name=%s id=%s',
                     global_role.name, global_role.id)
         return global_role
 
     cache = _role_cache[domain.id]
-    if not cache:
-        # NOTE: client.roles.list() does NOT function like
-        # client.projects.list()! passing `domain=` does not work,
-        # `domain_id=` must be used explicitly
-        cache.extend(client.roles.list(domain_id=domain.id))
-
-    role = first(lambda r: r.name == name, cache)
-    if role:
-        logger.info('found existing domain-scoped role: role=%s domain=%s',
-                    role.name, domain.name)
-    else:
+    # NOTE: client.roles.list() does NOT function like
+    # client.projects.list()! passing `domain=` does not work,
+    # `domain_id=` must be used explicitly
+    cache.ensure_loaded(lambda: client.roles.list(domain_id=domain.id))
+
+    def create():
         logger.info('creating new domain-scoped role: %s', name)
-        role = client.roles.create(name, domain)
-        cache.append(role)
+        return client.roles.create(name, domain)
+
+    role, created = cache.find_or_create(name, create)
+    if created:
         logger.debug('created domain-scoped role: %r', role)
+    else:
+        logger.info('found existing domain-scoped role: role=%s domain=%s',
+                    role.name, domain.name)
 
     return role
 
@@ -305,18 +647,18 @@ def get_or_create_group(client, domain, name):
     :rtype: keystoneclient.v3.groups.Group
     """
     cache = _group_cache[domain.id]
-    if not cache:
-        cache.extend(client.groups.list())
+    cache.ensure_loaded(client.groups.list)
 
-    group = first(lambda g: g.name == name, cache)
-    if group:
-        logger.info('found existing group %s in domain %s',
-                    group.name, domain.name)
-    else:
+    def create():
         logger.info('creating new group %s in domain %s', name, domain.name)
-        group = client.groups.create(name, domain=domain)
-        cache.append(group)
+        return client.groups.create(name, domain=domain)
+
+    group, created = cache.find_or_create(name, create)
+    if created:
         logger.debug('created group %r', group)
+    else:
+        logger.info('found existing group %s in domain %s',
+                    group.name, domain.name)
 
     return group
 
@@ -332,81 +674,135 @@ def get_or_create_service(client, name, service_type, description):
     :return:
     :rtype: keystoneclient.v3.services.Service
     """
-    if not _service_cache:
-        _service_cache.extend(client.services.list())
+    _service_cache.ensure_loaded(client.services.list)
 
-    service = first(lambda s: s.name == name, _service_cache)
-    if service:
-        logger.info('found existing service: %s', service.name)
-    else:
+    def create():
         logger.info('creating new service %s of %s type', name, service_type)
-        service = client.services.create(
+        return client.services.create(
             name=name,
             type=service_type,
             description=description,
         )
-        _service_cache.append(service)
+
+    service, created = _service_cache.find_or_create(name, create)
+    if created:
         logger.debug('created service %r', service)
+    else:
+        logger.info('found existing service: %s', service.name)
 
     return service
 
 
-@retry()
-def get_or_create_endpoint(client, service, url, endpoint):
-    """Get endpoint or create it if doesn't exist.
+class EndpointPlan(object):
+    """The endpoint changes needed to reach the desired service catalog."""
+
+    def __init__(self):
+        self.create = []
+        self.update = []
+        self.delete = []
+
+    def __len__(self):
+        return len(self.create) + len(self.update) + len(self.delete)
+
+
+def diff_endpoints(desired, existing, managed_service_ids, prune=False):
+    """
+    Compares the desired endpoints with one listing of the current ones.
+
+    Each (service, interface, region) keeps at most one endpoint: one whose
+    url already matches is preferred, otherwise the first is updated. When
+    pruning, duplicates and endpoints of managed services that are no longer
+    desired are deleted; endpoints of other services are never touched.
+
+    :param desired: dict of endpoint key -> (service, endpoint config)
+    :type existing: list[keystoneclient.v3.endpoints.Endpoint]
+    :type managed_service_ids: set[str]
+    :type prune: bool
+    :rtype: EndpointPlan
+    """
+    current = defaultdict(list)
+    for endpoint in existing:
+        current[endpoint_key(endpoint)].append(endpoint)
+
+    plan = EndpointPlan()
+    for key, (service, endpoint) in desired.items():
+        candidates = current.pop(key, [])
+        if not candidates:
+            plan.create.append((service, endpoint))
+            continue
+
+        matching = [e for e in candidates if e.url == endpoint['url']]
+        keep = matching[0] if matching else candidates[0]
+        if keep.url != endpoint['url']:
+            plan.update.append((keep, service, endpoint))
+
+        if prune:
+            plan.delete.extend(e for e in candidates if e is not keep)
 
+    if prune:
+        for (service_id, _, _), endpoints in current.items():
+            if service_id in managed_service_ids:
+                plan.delete.extend(endpoints)
+
+    return plan
+
+
+@retry()
+def create_endpoint(client, service, endpoint):
+    """
     :type client: keystoneclient.v3.client.Client
     :type service: keystoneclient.v3.services.Service
-    :type url: str
     :type endpoint: dict[str, str]
-    :return:
     :rtype: keystoneclient.v3.endpoints.Endpoint
     """
-    global _endpoint_cache
-    if not _endpoint_cache:
-        _endpoint_cache.extend(client.endpoints.list())
-
-    logger.debug('existing endpoints %r', _endpoint_cache)
-
-    endpoints = filter(lambda ep: ep.service_id == service.id, _endpoint_cache)
-    logger.debug('filtered endpoints %r', endpoints)
-
-    for e in endpoints:
-        if e.service_id == service.id:
-            if e.interface == endpoint['interface']:
-                if e.url == endpoint['url']:
-                    logger.debug('endpoint already exists %r', e)
-                    return e
-
-                logger.info('updating endpoint %r', e)
-                endpoint = client.endpoints.update(
-                    endpoint=e.id,
-                    service=service,
-                    url=endpoint['url'],
-                    interface=endpoint['interface'],
-                    region=endpoint['region'],
-                )
-                _endpoint_cache = [endpoint
-                                   if x.id == endpoint.id else x
-                                   for x in _endpoint_cache]
-                return endpoint
-
     logger.info(
         'creating new %s endpoint %s with url: %s on %s region',
         endpoint['interface'], service.name,
         endpoint['url'], endpoint['region']
     )
 
-    endpoint = client.endpoints.create(
+    created = client.endpoints.create(
+        service=service,
+        url=endpoint['url'],
+        interface=endpoint['interface'],
+        region=endpoint['region'],
+    )
+    logger.debug('created endpoint %r', created)
+
+    return created
+
+
+@retry()
+def update_endpoint(client, existing, service, endpoint):
+    """
+    :type client: keystoneclient.v3.client.Client
+    :type existing: keystoneclient.v3.endpoints.Endpoint
+    :type service: keystoneclient.v3.services.Service
+    :type endpoint: dict[str, str]
+    :rtype: keystoneclient.v3.endpoints.Endpoint
+    """
+    logger.info('updating endpoint %r', existing)
+    return client.endpoints.update(
+        endpoint=existing.id,
         service=service,
         url=endpoint['url'],
         interface=endpoint['interface'],
         region=endpoint['region'],
     )
-    _endpoint_cache.append(endpoint)
-    logger.debug('created endpoint %r', endpoint)
 
-    return endpoint
+
+@retry()
+def delete_endpoint(client, endpoint):
+    """
+    :type client: keystoneclient.v3.client.Client
+    :type endpoint: keystoneclient.v3.endpoints.Endpoint
+    """
+    logger.info('deleting stale %s endpoint %s (%s)', endpoint.interface,
+                endpoint.id, endpoint.url)
+    try:
+        client.endpoints.delete(endpoint.id)
+    except NotFound:
+        logger.debug('endpoint %s was already deleted', endpoint.id)
 
 
 @retry()
@@ -419,8 +815,10 @@ def get_user(client, domain, name):
     :return:
     :rtype: keystoneclient.v3.users.User
     """
-    # don't really need to cache users since we only touch each user once
-    return first(lambda u: u.name == name, client.users.list(domain=domain))
+    # list every user in the domain once rather than once per user
+    cache = _user_cache[domain.id]
+    cache.ensure_loaded(lambda: client.users.list(domain=domain))
+    return cache.find(name)
 
 
 @retry()
@@ -436,6 +834,10 @@ def create_user(client, username, **kwargs):
     user = client.users.create(username, **kwargs)
     logger.info("created user %s", username)
 
+    domain = kwargs.get('domain')
+    if domain is not None:
+        _user_cache[domain.id].add(user)
+
     return user
 
 
@@ -463,9 +865,22 @@ def get_role_assignments(client, user, project):
     :type user: keystoneclient.v3.users.User
     :param project:
     :type project: keystoneclient.v3.projects.Project
-    :return:
+    :return: the ids of roles directly assigned to the user on the project
+    :rtype: set[str]
     """
-    return client.role_assignments.list(user=user, project=project)
+    if project is not None:
+        # one listing of the project's assignments serves all of its users,
+        # without fetching assignments the preload has nothing to do with
+        _role_assignments.ensure_loaded(
+            ('project', project.id),
+            lambda: client.role_assignments.list(project=project))
+    else:
+        _role_assignments.ensure_loaded(
+            ('user', user.id),
+            lambda: client.role_assignments.list(user=user))
+
+    return _role_assignments.role_ids(user.id,
+                                      project.id if project else None)
 
 
 @retry()
@@ -483,6 +898,7 @@ def grant_role(client, role_id, user, project):
     :return:
     """
     client.roles.grant(role_id, user=user, project=project)
+    _role_assignments.add(user.id, project.id if project else None, role_id)
 
 
 def ensure_user_in_group(client, user, group):
@@ -524,6 +940,45 @@ def ensure_kubernetes_namespace(client, namespace):
 
 
 @retry()
+def list_kubernetes_secrets(client, namespace):
+    """
+    Lists all secrets in a namespace, in pages of SECRET_LIST_LIMIT. Paged
+    lists are never served from the client's response cache.
+
+    :type client: kubernetes.KubernetesAPIClient
+    :type namespace: str
+    :return: list of secrets, or None if listing them is forbidden
+    """
+    try:
+        return list(client.list_iter('/api/v1/namespaces/{}/secrets',
+                                     namespace, limit=SECRET_LIST_LIMIT))
+    except HTTPError as err:
+        if err.response.status_code != 403:
+            raise
+
+        return None
+
+
+@retry()
+def read_kubernetes_secret(client, namespace, name, cache=True):
+    """
+
+    :type client: kubernetes.KubernetesAPIClient
+    :type namespace: str
+    :type name: str
+    :param cache: if False, bypass the client's response cache
+    :return: the secret, or None if it does not exist
+    """
+    try:
+        return client.get('/api/v1/namespaces/{}/secrets/{}', namespace, name,
+                          cache=cache)
+    except HTTPError as err:
+        if err.response.status_code != 404:
+            raise
+
+        return None
+
+
 def get_kubernetes_secret(name, namespace=None):
     """
 
@@ -536,13 +991,7 @@ def get_kubernetes_secret(name, namespace=None):
     if namespace is None:
         namespace = get_current_namespace()
 
-    try:
-        return client.get('/api/v1/namespaces/{}/secrets/{}', namespace, name)
-    except HTTPError as err:
-        if err.response.status_code != 404:
-            raise
-
-        return None
+    return _secret_cache.get(client, namespace, name)
 
 
 def create_kubernetes_secret(fields, name, namespace=None, replace=False):
@@ -562,7 +1011,7 @@ def create_kubernetes_secret(fields, name, namespace=None, replace=False):
     if namespace is None:
         namespace = get_current_namespace()
 
-    ensure_kubernetes_namespace(client, namespace)
+    _secret_cache.ensure_namespace(client, namespace)
 
     encoded = {k: base64.b64encode(v) for k, v in fields.iteritems()}
     secret = {
@@ -582,12 +1031,15 @@ def create_kubernetes_secret(fields, name, namespace=None, replace=False):
     if replace:
         logger.info('replacing secret "%s" in namespace "%s"',
                     name, namespace)
-        return client.request('PUT', '/api/v1/namespaces/{}/secrets/{}',
-                              namespace, name, json=secret)
+        result = client.request('PUT', '/api/v1/namespaces/{}/secrets/{}',
+                                namespace, name, json=secret)
+    else:
+        logger.info('creating secret "%s" in namespace "%s"', name, namespace)
+        result = client.post('/api/v1/namespaces/{}/secrets',
+                             namespace, json=secret)
 
-    logger.info('creating secret "%s" in namespace "%s"', name, namespace)
-    return client.post('/api/v1/namespaces/{}/secrets',
-                       namespace, json=secret)
+    _secret_cache.put(namespace, name, result)
+    return result
 
 
 def diff_kubernetes_secret(secret, desired_fields):
@@ -774,8 +1226,7 @@ def load_user(ks, domain, user_cfg, member_role_name, admin_url=None):
             group = get_or_create_group(ks, domain, group_name)
             ensure_user_in_group(ks, user, group)
 
-    current_roles = get_role_assignments(ks, user, project)
-    current_ids = set(map(lambda a: a.role['id'], current_roles))
+    current_ids = get_role_assignments(ks, user, project)
 
     desired_role_names = user_cfg.get('roles', [])
     desired_role_names.append(member_role_name)
@@ -799,83 +1250,374 @@ def load_domains(ks, domains, member_role_name):
     :type member_role_name: str
     :return:
     """
-    for name, options in domains.iteritems():
-        domain = get_or_create_domain(ks, None if name == 'default' else name)
-        admin_url = get_keystone_admin_url(ks, domain)
+    if WORKERS > 1:
+        logger.info('reconciling domains using %d workers', WORKERS)
+        domain_pool = ThreadPool(min(WORKERS, len(domains)) or 1)
+        user_pool = ThreadPool(WORKERS)
+        try:
+            domain_pool.map(
+                lambda item: load_domain(ks, item[0], item[1],
+                                         member_role_name, user_pool),
+                domains.items())
+        finally:
+            # reap the workers before anything (e.g. save_state) runs next
+            domain_pool.close()
+            user_pool.close()
+            domain_pool.join()
+            user_pool.join()
+    else:
+        for name, options in domains.iteritems():
+            load_domain(ks, name, options, member_role_name)
+
+    logger.info('all domains initialized successfully')
+
+
+def load_domain(ks, name, options, member_role_name, pool=None):
+    """
+
+    :type ks: keystoneclient.v3.client.Client
+    :type name: str
+    :type options: dict[str, list]
+    :type member_role_name: str
+    :param pool: if set, users are reconciled concurrently using this pool
+    :type pool: multiprocessing.pool.ThreadPool or None
+    :return:
+    """
+    domain = get_or_create_domain(ks, None if name == 'default' else name)
+    admin_url = get_keystone_admin_url(ks, domain)
 
-        logger.info('creating projects...')
-        for project in options.get('projects', []):
-            get_or_create_project(ks, domain, project)
+    logger.info('creating projects...')
+    for project in options.get('projects', []):
+        get_or_create_project(ks, domain, project)
 
-        logger.info('creating roles...')
-        for role in options.get('roles', []):
-            get_or_create_role(ks, domain, role)
+    logger.info('creating roles...')
+    for role in options.get('roles', []):
+        get_or_create_role(ks, domain, role)
 
-        logger.info('creating groups...')
-        for group in options.get('groups', []):
-            get_or_create_group(ks, domain, group)
+    logger.info('creating groups...')
+    for group in options.get('groups', []):
+        get_or_create_group(ks, domain, group)
 
-        logger.info('creating users...')
-        for user_cfg in options.get('users', []):
-            assert isinstance(user_cfg, dict)
+    logger.info('creating users...')
+    user_cfgs = options.get('users', [])
+    for user_cfg in user_cfgs:
+        assert isinstance(user_cfg, dict)
 
-            load_user(ks, domain, user_cfg, member_role_name, admin_url)
+    def load(user_cfg):
+        load_user(ks, domain, user_cfg, member_role_name, admin_url)
 
-        logger.info('finished initializing domain %s', name)
+    if pool is not None:
+        # independent users, shared resources are de-duplicated by the
+        # caches so the same project or group is only created once
+        pool.map(load, user_cfgs)
+    else:
+        for user_cfg in user_cfgs:
+            load(user_cfg)
 
-    logger.info('all domains initialized successfully')
+    logger.info('finished initializing domain %s', name)
 
 
 def load_services(ks, services):
     """Load services into Keystone.
 
+    The desired catalog is diffed against a single endpoint listing, and the
+    resulting creates, updates and deletes are applied using up to `WORKERS`
+    threads.
+
     :type ks: keystoneclient.v3.client.Client
     :type services: dict[str, dict[str, list]]
     :return:
     """
-    for name, options in services.viewitems():
+    def load_service(item):
+        name, options = item
         logger.debug('%r', options)
-        logger.info('creating service...')
-        service = get_or_create_service(
+        return get_or_create_service(
             client=ks,
             name=name,
             service_type=options.get('type'),
             description=options.get('description', None)
         )
 
-        logger.info('creating %s endpoints...', name)
+    logger.info('creating services...')
+    items = [(name, options or {}) for name, options in services.items()]
+    loaded = parallel_map(load_service, items)
+
+    desired = {}
+    for (name, options), service in zip(items, loaded):
         for endpoint in options.get('endpoints', []):
             assert isinstance(endpoint, dict)
-
-            get_or_create_endpoint(
-                client=ks,
-                service=service,
-                url=options.get('url', ''),
-                endpoint=endpoint
-            )
+            key = (service.id, endpoint['interface'], endpoint['region'])
+            if key in desired:
+                raise KeystoneInitException(
+                    'service {} has multiple {} endpoints in region '
+                    '{}'.format(name, endpoint['interface'],
+                                endpoint['region']))
+
+            desired[key] = (service, endpoint)
+
+    plan = diff_endpoints(desired, list_endpoints(ks),
+                          set(service.id for service in loaded),
+                          prune=PRUNE_ENDPOINTS)
+    logger.info('endpoint changes: %d to create, %d to update, %d to delete',
+                len(plan.create), len(plan.update), len(plan.delete))
+
+    operations = [lambda args=args: create_endpoint(ks, *args)
+                  for args in plan.create]
+    operations += [lambda args=args: update_endpoint(ks, *args)
+                   for args in plan.update]
+    operations += [lambda e=e: delete_endpoint(ks, e) for e in plan.delete]
+    parallel_map(lambda operation: operation(), operations)
 
     logger.info('all services initialized successfully')
 
 
-def main():
+@retry()
+def list_endpoints(client):
+    """
+    :type client: keystoneclient.v3.client.Client
+    :rtype: list[keystoneclient.v3.endpoints.Endpoint]
+    """
+    return client.endpoints.list()
+
+
+def parallel_map(func, items):
+    """
+    Maps `func` over `items` using up to `WORKERS` threads, or serially if
+    only one worker is configured.
+
+    :type items: list
+    :rtype: list
+    """
+    if WORKERS <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    pool = ThreadPool(min(WORKERS, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+
+
+def preload_fingerprint(preload):
+    """
+    Hashes the preload config together with the Keystone it is applied to.
+
+    :type preload: dict
+    :rtype: str
+    """
+    canonical = json.dumps({
+        'auth_url': os.environ.get('OS_AUTH_URL'),
+        'preload': preload
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def preload_secrets(preload):
+    """
+    :type preload: dict
+    :return: (namespace, name) of every secret referenced by the preload
+    :rtype: set[(str, str)]
+    """
+    secrets = set()
+    for options in preload.get('domains', {}).values():
+        for user_cfg in (options or {}).get('users', []):
+            if 'secret' in user_cfg:
+                s_namespace, s_name = parse_secret(user_cfg['secret'])
+                if s_namespace is None:
+                    s_namespace = get_current_namespace()
+                secrets.add((s_namespace, s_name))
+
+    return secrets
+
+
+def get_state_summary(ks, preload):
+    """
+    Summarizes the remote state produced by a preload cheaply: resource
+    counts from a handful of list calls, plus the resourceVersion of each
+    referenced secret. Always fetched fresh, bypassing both the secret cache
+    and the Kubernetes response cache.
+
+    :type ks: keystoneclient.v3.client.Client
+    :type preload: dict
+    :rtype: dict
+    """
+    summary = {
+        'domains': len(ks.domains.list()),
+        'projects': len(ks.projects.list()),
+        'roles': len(ks.roles.list()),
+        'users': len(ks.users.list()),
+        'services': len(ks.services.list()),
+        'endpoints': len(ks.endpoints.list()),
+    }
+
+    secrets = preload_secrets(preload)
+    if secrets:
+        client = get_kubernetes_client()
+        versions = {}
+        unlisted = set(ns for ns, _ in secrets)
+        if SECRET_LIST:
+            for namespace in set(unlisted):
+                listed = list_kubernetes_secrets(client, namespace)
+                if listed is None:
+                    continue
+
+                unlisted.discard(namespace)
+                for secret in listed:
+                    versions[(namespace, secret.metadata.name)] = \
+                        secret.metadata.resourceVersion
+
+        for namespace, name in secrets:
+            if namespace in unlisted:
+                secret = read_kubernetes_secret(client, namespace, name,
+                                                cache=False)
+                if secret is not None:
+                    versions[(namespace, name)] = \
+                        secret.metadata.resourceVersion
+
+        summary['secrets'] = {
+            '{}/{}'.format(ns, name): versions.get((ns, name))
+            for ns, name in secrets
+        }
+
+    # normalize through JSON so it compares equal to a stored summary
+    return json.loads(json.dumps(summary))
+
+
+def load_state():
+    """
+    Loads the state stored by the last successful run.
+
+    :return: the state dict, or None if there is none
+    """
+    if STATE_CONFIGMAP:
+        client = get_kubernetes_client()
+        try:
+            configmap = client.get('/api/v1/namespaces/{}/configmaps/{}',
+                                   get_current_namespace(), STATE_CONFIGMAP)
+        except HTTPError as e:
+            if e.response.status_code != 404:
+                raise
+
+            return None
+
+        if 'data' not in configmap:
+            return None
+
+        data = configmap['data'].get(STATE_CONFIGMAP_KEY)
+        return json.loads(data) if data else None
+
+    if STATE_FILE and os.path.exists(STATE_FILE):
+        with open(STATE_FILE, 'r') as f:
+            return json.load(f)
+
+    return None
+
+
+def save_state(state):
+    """
+    Persists the state of a successful run, see load_state().
+
+    :type state: dict
+    """
+    serialized = json.dumps(state, sort_keys=True)
+
+    if STATE_CONFIGMAP:
+        client = get_kubernetes_client()
+        namespace = get_current_namespace()
+        configmap = {
+            'kind': 'ConfigMap',
+            'apiVersion': 'v1',
+            'metadata': {
+                'name': STATE_CONFIGMAP,
+                'namespace': namespace,
+                'labels': {
+                    'heritage': 'keystone-init-job'
+                }
+            },
+            'data': {STATE_CONFIGMAP_KEY: serialized}
+        }
+
+        resp = client.request('PUT', '/api/v1/namespaces/{}/configmaps/{}',
+                              namespace, STATE_CONFIGMAP, json=configmap,
+                              raise_for_status=False)
+        if resp.status_code == 404:
+            client.post('/api/v1/namespaces/{}/configmaps', namespace,
+                        json=configmap)
+        else:
+            resp.response.raise_for_status()
+
+        logger.info('saved state to configmap %s/%s',
+                    namespace, STATE_CONFIGMAP)
+    elif STATE_FILE:
+        tmp_path = STATE_FILE + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(serialized)
+        os.rename(tmp_path, STATE_FILE)
+        logger.info('saved state to %s', STATE_FILE)
+
+
+def reconcile(ks, preload):
+    """
+
+    :type ks: keystoneclient.v3.client.Client
+    :type preload: dict
+    """
+    # if a _member_ role doesn't exist, create it globally
+    member_role_name = preload.get('member_role', DEFAULT_MEMBER_ROLE)
+    logger.info('making sure member role (%s) exists...', member_role_name)
+    get_or_create_global_role(ks, member_role_name)
+
+    if 'global_roles' in preload:
+        load_global_roles(ks, preload['global_roles'])
+
+    if 'domains' in preload:
+        load_domains(ks, preload['domains'], member_role_name)
+
+    if 'services' in preload:
+        load_services(ks, preload['services'])
+
+
+def run():
     ks = get_keystone_client()
 
     with open(PRELOAD_PATH, 'r') as f:
         preload = yaml.safe_load(f)
 
-        # if a _member_ role doesn't exist, create it globally
-        member_role_name = preload.get('member_role', DEFAULT_MEMBER_ROLE)
-        logger.info('making sure member role (%s) exists...', member_role_name)
-        get_or_create_global_role(ks, member_role_name)
+    state_enabled = bool(STATE_CONFIGMAP or STATE_FILE)
+    if state_enabled:
+        # computed up front, reconciling modifies parts of the config
+        fingerprint = preload_fingerprint(preload)
+
+        state = load_state()
+        if state and state.get('fingerprint') == fingerprint:
+            if get_state_summary(ks, preload) == state.get('summary'):
+                logger.info('preload and remote state are unchanged since '
+                            'the last successful run, nothing to do')
+                return
+
+            logger.info('remote state changed since the last run')
+        else:
+            logger.info('preload changed since the last run')
+
+    reconcile(ks, preload)
 
-        if 'global_roles' in preload:
-            load_global_roles(ks, preload['global_roles'])
+    if state_enabled:
+        save_state({
+            'fingerprint': fingerprint,
+            'summary': get_state_summary(ks, preload)
+        })
 
-        if 'domains' in preload:
-            load_domains(ks, preload['domains'], member_role_name)
 
-        if 'services' in preload:
-            load_services(ks, preload['services'])
+def main():
+    try:
+        run()
+    finally:
+        retry_policy.log_stats(logger)
+        api_metrics.report(logger)
+        if _kubernetes_client is not None \
+                and _kubernetes_client.cache is not None:
+            logger.info('kubernetes response cache: %r',
+                        _kubernetes_client.cache.stats())
 
 
 if __name__ == '__main__':
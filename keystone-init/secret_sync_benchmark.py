@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Benchmarks the Kubernetes secret sync of keystone_init.py against the
+in-process FakeKubernetesAPI. Keystone is not involved.
+
+Each user of a generated preload gets its secret reconciled the way
+load_user() does it: the secret is looked up, its password reused or a new
+one generated, and the secret created or replaced if its fields differ.
+Three cases are run per worker count:
+
+ * `new`: none of the secrets exist yet
+ * `unchanged`: every secret exists and is up to date
+ * `changed`: every secret exists, but `--changed` of them are outdated
+
+Requires the same packages as keystone_init.py itself.
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+import keystone_init
+import kubernetes
+
+from kubernetes import KubernetesAPIClient
+
+# the fake API is shared by the benchmarks of all images
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'tools', 'fakes'))
+
+from fake_kubernetes_api import FakeKubernetesAPI
+
+AUTH_URL = 'http://keystone:5000/v3'
+DOMAIN = 'Default'
+CASES = ('new', 'unchanged', 'changed')
+
+
+def _users(count, namespaces):
+    return [{
+        'username': 'user-{:d}'.format(i),
+        'project': 'project-{:d}'.format(i % 10),
+        'secret': 'namespace-{:d}/user-{:d}-secret'.format(i % namespaces, i)
+    } for i in range(count)]
+
+
+def _fields(user_cfg, password):
+    project = user_cfg['project']
+    return {
+        'OS_USERNAME': user_cfg['username'],
+        'OS_PASSWORD': password,
+        'OS_AUTH_URL': AUTH_URL,
+        'OS_USER_DOMAIN_NAME': DOMAIN,
+        'OS_PROJECT_NAME': project,
+        'OS_PROJECT_ID': project + '-id',
+        'OS_PROJECT_DOMAIN_NAME': DOMAIN,
+    }
+
+
+def _seed(api, case, users, namespaces, changed):
+    for i in range(namespaces):
+        api.add_namespace('namespace-{:d}'.format(i))
+
+    if case != 'new':
+        outdated = int(round(len(users) * changed)) if case == 'changed' \
+            else 0
+        for i, user_cfg in enumerate(users):
+            namespace, name = keystone_init.parse_secret(user_cfg['secret'])
+            fields = _fields(user_cfg, 'password-{:d}'.format(i))
+            if i < outdated:
+                fields['OS_AUTH_URL'] = 'http://old-keystone:5000/v3'
+            api.add_secret(namespace, name, fields,
+                           labels={'heritage': 'keystone-init-job'})
+
+    api.reset_counts()
+
+
+def sync_secret(user_cfg):
+    """The secret handling of keystone_init.load_user()"""
+    namespace, name = keystone_init.parse_secret(user_cfg['secret'])
+    secret = keystone_init.get_kubernetes_secret(name, namespace)
+    if secret:
+        password = keystone_init.get_password(secret)
+    else:
+        password = keystone_init.generate_password()
+
+    keystone_init.ensure_kubernetes_secret(
+        secret, _fields(user_cfg, password), user_cfg['secret'])
+
+
+def run_case(args, case, workers):
+    api = FakeKubernetesAPI(latency=args.latency)
+    api.start()
+    try:
+        users = _users(args.users, args.namespaces)
+        _seed(api, case, users, args.namespaces, args.changed)
+
+        client = KubernetesAPIClient(qps=args.qps, burst=args.burst)
+        client.api_url = api.url
+
+        keystone_init._kubernetes_client = client
+        keystone_init._secret_cache = keystone_init.SecretCache(
+            list_namespaces=args.list_secrets)
+        keystone_init.WORKERS = workers
+
+        start = time.time()
+        keystone_init.parallel_map(sync_secret, users)
+        elapsed = time.time() - start
+
+        return {
+            'case': case,
+            'users': args.users,
+            'workers': workers,
+            'seconds': elapsed,
+            'calls': api.total_calls(),
+            'call_counts': api.call_counts(),
+        }
+    finally:
+        api.stop()
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        prog='secret_sync_benchmark',
+        description='Benchmark keystone-init secret sync against a '
+                    'fake Kubernetes API')
+    parser.add_argument('--users', type=int, default=500,
+                        help='Number of users with a secret in the preload')
+    parser.add_argument('--namespaces', type=int, default=1,
+                        help='Number of namespaces the secrets are spread '
+                             'over')
+    parser.add_argument('--changed', type=float, default=0.1,
+                        help='Fraction of secrets outdated in the `changed` '
+                             'case')
+    parser.add_argument('--cases', default=','.join(CASES),
+                        help='Comma separated cases to run')
+    parser.add_argument('--workers', default='1,8',
+                        help='Comma separated KEYSTONE_INIT_WORKERS values')
+    parser.add_argument('--list-secrets', action='store_true',
+                        help='List each namespace once (SECRET_LIST) instead '
+                             'of reading secrets one by one')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Seconds of latency added to every API request')
+    parser.add_argument('--qps', type=float, default=kubernetes.QPS,
+                        help='Client side request rate limit, 0 to disable')
+    parser.add_argument('--burst', type=int, default=kubernetes.BURST,
+                        help='Client side request burst')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Show job logs and API calls per verb')
+    return parser
+
+
+def main(args=None):
+    args = _get_parser().parse_args(args)
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    print('{:>10} {:>6} {:>8} {:>10} {:>8}'.format(
+        'case', 'users', 'workers', 'seconds', 'calls'))
+    for workers in [int(w) for w in args.workers.split(',')]:
+        for case in args.cases.split(','):
+            result = run_case(args, case, workers)
+            print('{case:>10} {users:>6d} {workers:>8d} {seconds:>10.3f} '
+                  '{calls:>8d}'.format(**result))
+            if args.verbose:
+                for call, n in sorted(result['call_counts'].items()):
+                    print('    {:<28} {:>8d}'.format(call, n))
+
+
+if __name__ == '__main__':
+    main()
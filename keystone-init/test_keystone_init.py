@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Unit tests for keystone_init.py, run with:
+
+    python -m unittest discover -s keystone-init
+
+Requires the same packages as keystone_init.py itself.
+"""
+
+import unittest
+
+import keystone_init
+
+
+class Resource(object):
+    def __init__(self, id, name=None):
+        self.id = id
+        self.name = name or id
+
+
+class Assignment(object):
+    def __init__(self, user_id, role_id, project_id=None):
+        self.user = {'id': user_id}
+        self.role = {'id': role_id}
+        self.scope = {'project': {'id': project_id}} if project_id else {}
+
+
+class GroupAssignment(object):
+    def __init__(self, group_id, role_id, project_id):
+        self.group = {'id': group_id}
+        self.role = {'id': role_id}
+        self.scope = {'project': {'id': project_id}}
+
+
+class FakeRoleAssignments(object):
+    """Records the filters of each `list` call."""
+
+    def __init__(self, assignments):
+        self.assignments = assignments
+        self.calls = []
+
+    def list(self, user=None, project=None):
+        self.calls.append({'user': user.id if user else None,
+                           'project': project.id if project else None})
+        return [a for a in self.assignments
+                if (user is None or
+                    getattr(a, 'user', {}).get('id') == user.id) and
+                (project is None or
+                 a.scope.get('project', {}).get('id') == project.id)]
+
+
+class FakeClient(object):
+    def __init__(self, assignments):
+        self.role_assignments = FakeRoleAssignments(assignments)
+
+
+class GetRoleAssignmentsTest(unittest.TestCase):
+
+    def setUp(self):
+        self._index = keystone_init._role_assignments
+        keystone_init._role_assignments = keystone_init.RoleAssignmentIndex()
+
+        self.client = FakeClient([
+            Assignment('alice', 'member', 'p1'),
+            Assignment('alice', 'admin', 'p1'),
+            Assignment('bob', 'member', 'p1'),
+            Assignment('bob', 'reader', 'p2'),
+            Assignment('bob', 'domain-admin'),
+            GroupAssignment('ops', 'admin', 'p1'),
+        ])
+
+    def tearDown(self):
+        keystone_init._role_assignments = self._index
+
+    def test_listing_is_scoped_to_the_project(self):
+        alice, bob = Resource('alice'), Resource('bob')
+        p1 = Resource('p1')
+
+        self.assertEqual(keystone_init.get_role_assignments(
+            self.client, alice, p1), {'member', 'admin'})
+        self.assertEqual(keystone_init.get_role_assignments(
+            self.client, bob, p1), {'member'})
+
+        # never an unfiltered listing, and one listing per project only
+        self.assertEqual(self.client.role_assignments.calls,
+                         [{'user': None, 'project': 'p1'}])
+
+    def test_each_project_is_listed_once(self):
+        bob = Resource('bob')
+
+        keystone_init.get_role_assignments(self.client, bob, Resource('p1'))
+        keystone_init.get_role_assignments(self.client, bob, Resource('p2'))
+        keystone_init.get_role_assignments(self.client, bob, Resource('p2'))
+
+        self.assertEqual(self.client.role_assignments.calls,
+                         [{'user': None, 'project': 'p1'},
+                          {'user': None, 'project': 'p2'}])
+
+    def test_unscoped_lookup_lists_the_user(self):
+        bob = Resource('bob')
+
+        self.assertEqual(keystone_init.get_role_assignments(
+            self.client, bob, None), {'member', 'reader', 'domain-admin'})
+        self.assertEqual(self.client.role_assignments.calls,
+                         [{'user': 'bob', 'project': None}])
+
+    def test_grants_are_indexed(self):
+        alice, p2 = Resource('alice'), Resource('p2')
+        self.client.roles = type('Roles', (object,), {
+            'grant': lambda self, role_id, user, project: None})()
+
+        self.assertEqual(keystone_init.get_role_assignments(
+            self.client, alice, p2), set())
+        keystone_init.grant_role(self.client, 'member', alice, p2)
+
+        self.assertEqual(keystone_init.get_role_assignments(
+            self.client, alice, p2), {'member'})
+        self.assertEqual(len(self.client.role_assignments.calls), 1)
+
+
+class VersionedUrlTest(unittest.TestCase):
+
+    def test_unversioned_url_gets_v3(self):
+        self.assertEqual(keystone_init.versioned_url('http://keystone:5000'),
+                         'http://keystone:5000/v3')
+        self.assertEqual(
+            keystone_init.versioned_url('https://example.com/identity/'),
+            'https://example.com/identity/v3')
+
+    def test_versioned_url_is_kept(self):
+        for url in ('http://keystone:5000/v3', 'http://keystone:5000/v3/',
+                    'http://keystone:5000/v3.0', 'http://keystone:5000/v2.0'):
+            self.assertEqual(keystone_init.versioned_url(url),
+                             url.rstrip('/'))
+
+
+if __name__ == '__main__':
+    unittest.main()
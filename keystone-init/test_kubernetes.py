@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Unit tests for the response wrappers in kubernetes.py, run with:
+
+    python -m unittest discover -s keystone-init
+
+The same classes are copied into mysql-users-init and job-cleanup.
+"""
+
+import copy
+import json
+import unittest
+
+from kubernetes import KubernetesAPIResponse
+from kubernetes import LazyDict
+from kubernetes import LazyList
+
+
+def make_secret():
+    return {
+        'kind': 'Secret',
+        'metadata': {
+            'name': 'some-secret',
+            'labels': {'heritage': 'keystone-init-job'},
+        },
+        'data': {'OS_USERNAME': 'dXNlcg=='},
+        'items': [{'name': 'a'}, {'name': 'b', 'tags': ['x']}],
+    }
+
+
+class JsonTest(unittest.TestCase):
+
+    def test_response_dumps_as_decoded(self):
+        secret = make_secret()
+        res = KubernetesAPIResponse(None, copy.deepcopy(secret))
+
+        self.assertEqual(json.loads(json.dumps(res)), secret)
+
+    def test_wrapped_values_dump(self):
+        res = KubernetesAPIResponse(None, make_secret())
+
+        self.assertIsInstance(res.metadata, LazyDict)
+        self.assertIsInstance(res['items'], LazyList)
+        self.assertEqual(json.loads(json.dumps(res.metadata)),
+                         make_secret()['metadata'])
+        self.assertEqual(json.loads(json.dumps(res['items'])),
+                         make_secret()['items'])
+        self.assertEqual(json.loads(json.dumps(res['items'][1:])),
+                         [{'name': 'b', 'tags': ['x']}])
+
+    def test_changes_are_dumped(self):
+        res = KubernetesAPIResponse(None, make_secret())
+        res.metadata.labels['extra'] = 'yes'
+        res['items'][0].name = 'c'
+
+        dumped = json.loads(json.dumps(res))
+        self.assertEqual(dumped['metadata']['labels']['extra'], 'yes')
+        self.assertEqual(dumped['items'][0], {'name': 'c'})
+
+    def test_wrapping_leaves_the_decoded_body_alone(self):
+        secret = make_secret()
+        res = KubernetesAPIResponse(None, secret)
+        res.metadata.labels['extra'] = 'yes'
+        res.status.phase = 'Active'
+
+        self.assertEqual(secret, make_secret())
+
+
+class MissingKeyTest(unittest.TestCase):
+
+    def test_missing_key_is_empty(self):
+        res = KubernetesAPIResponse(None, make_secret())
+
+        self.assertEqual(res.status, {})
+        self.assertEqual(res['status'], {})
+        self.assertFalse(res.metadata.annotations)
+        self.assertEqual(list(res.status.conditions), [])
+        self.assertNotIn('status', res)
+
+    def test_get_returns_default(self):
+        obj = LazyDict({'a': {'b': 1}})
+
+        self.assertIsNone(obj.get('missing'))
+        self.assertEqual(obj.get('missing', 5), 5)
+        self.assertEqual(obj.get('a').b, 1)
+
+    def test_write_to_missing_key_attaches(self):
+        res = KubernetesAPIResponse(None, make_secret())
+        res.metadata.annotations['note'] = 'x'
+        res.spec.template.metadata.name = 'deep'
+
+        self.assertEqual(res.metadata.annotations, {'note': 'x'})
+        self.assertEqual(json.loads(json.dumps(res))['spec'],
+                         {'template': {'metadata': {'name': 'deep'}}})
+
+    def test_special_attributes_are_not_keys(self):
+        res = KubernetesAPIResponse('response', {})
+
+        self.assertEqual(res.response, 'response')
+        self.assertFalse(hasattr(res, '__missing_dunder__'))
+        self.assertEqual(copy.deepcopy(res), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,10 +7,14 @@
 from __future__ import print_function
 
 import os
+import random
 import sys
+import threading
 import time
 import urlparse
 
+from multiprocessing.pool import ThreadPool
+
 import yaml
 
 from keystoneauth1 import session as ks_session
@@ -18,6 +22,10 @@ from keystoneauth1.exceptions.connection import ConnectFailure
 from keystoneauth1.identity import v3
 from keystoneclient.v3 import client
 
+# users and role grants provisioned concurrently
+PRELOAD_WORKERS = int(os.environ.get('PRELOAD_WORKERS', '1'))
+RETRY_MAX_DELAY = float(os.environ.get('PRELOAD_RETRY_MAX_DELAY', '10.0'))
+
 
 def _get_auth_plugin(auth_url, **kwargs):
     kwargs = {
@@ -31,7 +39,7 @@ def _get_auth_plugin(auth_url, **kwargs):
     return v3.Password(auth_url=auth_url, **kwargs)
 
 
-def _retry(func, retries=5, exc=None):
+def _retry(func, retries=5, exc=None, delay=0.5):
     if exc is None:
         exc = (ConnectFailure,)
 
@@ -40,7 +48,10 @@ def _retry(func, retries=5, exc=None):
             return func()
         except exc as e:
             if i < retries - 1:
-                time.sleep(1.0)
+                # exponential backoff with full jitter, so concurrent workers
+                # don't retry in lockstep
+                time.sleep(random.uniform(
+                    0, min(RETRY_MAX_DELAY, delay * (2 ** (i + 1)))))
                 continue
             else:
                 print("Max retries reached after {:d} attempts: {}"
@@ -48,127 +59,242 @@ def _retry(func, retries=5, exc=None):
                 raise
 
 
-def get_default_domain(ks_client):
+class KeystoneSnapshot(object):
+    """Each Keystone collection, listed once and indexed by name and id.
+
+    Collections are fetched on first use and kept current as objects are
+    created or deleted through the snapshot, so lookups never hit the API.
+    The snapshot may be shared by worker threads.
+    """
+
+    def __init__(self, ks_client):
+        self.client = ks_client
+        self._by_name = {}
+        self._by_id = {}
+        self._endpoints = None
+        self._assignments = None
+        self._lock = threading.RLock()
+        self._create_locks = {}
+
+    def _load(self, collection):
+        with self._lock:
+            self._load_locked(collection)
+
+    def _load_locked(self, collection):
+        if collection not in self._by_id:
+            manager = getattr(self.client, collection)
+            items = _retry(lambda: manager.list())
+            self._by_id[collection] = {item.id: item for item in items}
+            by_name = {}
+            for item in items:
+                # keep the first match, as the linear scans did
+                by_name.setdefault(getattr(item, 'name', None), item)
+            self._by_name[collection] = by_name
+
+    def find(self, collection, name=None, id=None):
+        with self._lock:
+            self._load_locked(collection)
+            if id is not None and id in self._by_id[collection]:
+                return self._by_id[collection][id]
+            if name is not None:
+                return self._by_name[collection].get(name)
+            return None
+
+    def add(self, collection, item):
+        with self._lock:
+            self._load_locked(collection)
+            self._by_id[collection][item.id] = item
+            self._by_name[collection].setdefault(item.name, item)
+            return item
+
+    def find_or_create(self, collection, name, create):
+        """
+        Returns (item, created); concurrent callers for the same name wait
+        for a single create.
+        """
+        item = self.find(collection, name=name)
+        if item:
+            return item, False
+
+        with self._lock:
+            create_lock = self._create_locks.setdefault(
+                (collection, name), threading.Lock())
+
+        with create_lock:
+            item = self.find(collection, name=name)
+            if item:
+                return item, False
+            return self.add(collection, create()), True
+
+    def endpoints(self, service_id):
+        """Endpoints of the service, as a list that may be modified"""
+        with self._lock:
+            return self._endpoints_locked(service_id)
+
+    def _endpoints_locked(self, service_id):
+        if self._endpoints is None:
+            self._endpoints = {}
+            for endpoint in _retry(lambda: self.client.endpoints.list()):
+                self._endpoints.setdefault(endpoint.service_id, []).append(
+                    endpoint)
+        return self._endpoints.setdefault(service_id, [])
+
+    def role_ids(self, user, project):
+        """Ids of the roles the user has on the project, as a copy"""
+        with self._lock:
+            return set(self._role_ids_locked(user, project))
+
+    def add_role(self, user, project, role_id):
+        """Records a role granted to the user on the project"""
+        with self._lock:
+            self._role_ids_locked(user, project).add(role_id)
+
+    def _role_ids_locked(self, user, project):
+        if self._assignments is None:
+            self._assignments = {}
+            assignments = _retry(lambda: self.client.role_assignments.list())
+            for assignment in assignments:
+                if not hasattr(assignment, 'user'):
+                    continue
+                project_id = assignment.scope.get('project', {}).get('id')
+                key = (assignment.user['id'], project_id)
+                self._assignments.setdefault(key, set()).add(
+                    assignment.role['id'])
+        return self._assignments.setdefault((user.id, project.id), set())
+
+
+def get_default_domain(snapshot):
     """Get the default domain"""
-    for domain in _retry(lambda: ks_client.domains.list()):
-        if domain.id == "default":
-            return domain
-
-    return None
+    return snapshot.find('domains', id='default')
 
 
-def get_project(ks_client, project_name):
+def get_project(snapshot, project_name):
     """Get the project by name"""
-    for project in _retry(lambda: ks_client.projects.list()):
-        if project.name == project_name:
-            return project
+    return snapshot.find('projects', name=project_name)
 
-    return None
 
-
-def add_projects(ks_client, project_names):
+def add_projects(snapshot, project_names):
     """Add the given project_names if they don't already exist"""
-    default_domain = get_default_domain(ks_client)
-    for project_name in project_names:
-        if not get_project(ks_client, project_name):
-            _retry(lambda: ks_client.projects.create(name=project_name,
-                                                     domain=default_domain,
-                                                     enabled=True))
+    ks_client = snapshot.client
+    default_domain = get_default_domain(snapshot)
+
+    def add_project(project_name):
+        def create():
+            return _retry(lambda: ks_client.projects.create(
+                name=project_name, domain=default_domain, enabled=True))
+
+        _, created = snapshot.find_or_create('projects', project_name, create)
+        if created:
             print("Created project '{}'".format(project_name))
 
+    _map(add_project, project_names)
     return True
 
 
-def get_user(ks_client, user_name):
-    for user in _retry(lambda: ks_client.users.list()):
-        if user.name == user_name:
-            return user
-    return None
+def get_user(snapshot, user_name):
+    return snapshot.find('users', name=user_name)
 
 
-def get_role(ks_client, role_name=None, role_id=None):
-    for role in _retry(lambda: ks_client.roles.list()):
-        if role.name == role_name or role.id == role_id:
-            return role
-    return None
+def get_role(snapshot, role_name=None, role_id=None):
+    return snapshot.find('roles', name=role_name, id=role_id)
 
 
-def add_users(ks_client, users):
+def add_users(snapshot, users):
     """Add the given users if they don't already exist"""
-    for user in users:
-        if not get_user(ks_client, user['username']):
-            project_name = user['project']
-            project = get_project(ks_client, project_name)
-
-            password = user['password']
-            if 'email' in user:
-                email = user['email']
-            else:
-                email = None
-
-            _retry(lambda: ks_client.users.create(name=user['username'],
-                                                  password=password,
-                                                  email=email,
-                                                  project_id=project.id))
+    ks_client = snapshot.client
+
+    def add_user(user):
+        project = get_project(snapshot, user['project'])
+        password = user['password']
+        if 'email' in user:
+            email = user['email']
+        else:
+            email = None
+
+        def create():
+            return _retry(lambda: ks_client.users.create(
+                name=user['username'], password=password, email=email,
+                project_id=project.id))
+
+        _, created = snapshot.find_or_create('users', user['username'],
+                                             create)
+        if created:
             print("Created user '{}'".format(user['username']))
+
+    _map(add_user, users)
     return True
 
 
-def add_user_roles(ks_client, users):
+def add_user_roles(snapshot, users):
     """Add the roles for the users if they don't already have them"""
-    for user in users:
-        if 'role' not in user:
-            continue
-        role_name = user['role']
-        keystone_user = get_user(ks_client, user['username'])
-        project = get_project(ks_client, user['project'])
-
-        assignments = _retry(lambda: ks_client.role_assignments.list(
-            user=keystone_user,
-            project=project))
-        for assignment in assignments:
-            role = get_role(ks_client=ks_client, role_id=assignment.role['id'])
-            if role.name == role_name:
-                return True
+    ks_client = snapshot.client
 
-        role = get_role(ks_client=ks_client, role_name=role_name)
-        if not role:
-            role = _retry(lambda: ks_client.roles.create(role_name))
+    def add_user_role(user):
+        role_name = user['role']
+        keystone_user = get_user(snapshot, user['username'])
+        project = get_project(snapshot, user['project'])
+
+        roles = [get_role(snapshot, role_id=role_id)
+                 for role_id in snapshot.role_ids(keystone_user, project)]
+        if any(role is not None and role.name == role_name
+               for role in roles):
+            return
+
+        role, created = snapshot.find_or_create(
+            'roles', role_name,
+            lambda: _retry(lambda: ks_client.roles.create(role_name)))
+        if created:
             print("Created role '{}'".format(role_name))
 
         _retry(lambda: ks_client.roles.grant(user=keystone_user,
                                              role=role,
                                              project=project))
+        snapshot.add_role(keystone_user, project, role.id)
         print("Added role '{}' to user '{}'".format(role_name,
                                                     user['username']))
+
+    _map(add_user_role, [user for user in users if 'role' in user])
     return True
 
 
-def add_service_endpoint(ks_client, name, description, endpoint_type,
+def _map(func, items):
+    """Applies func to each item using PRELOAD_WORKERS threads"""
+    if PRELOAD_WORKERS <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    pool = ThreadPool(min(PRELOAD_WORKERS, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+
+
+def add_service_endpoint(snapshot, name, description, endpoint_type,
                          url, region, interface):
     """Add the Monasca service to the catalog with the specified endpoint,
     if it doesn't yet exist."""
-    services = _retry(lambda: ks_client.services.list())
-    service_names = {service.name: service for service in services}
-    if name in service_names.keys():
-        service = service_names[name]
-    else:
-        service = _retry(lambda: ks_client.services.create(
-            name=name,
-            type=endpoint_type,
-            description=description))
+    ks_client = snapshot.client
+    service = snapshot.find('services', name=name)
+    if not service:
+        service = snapshot.add('services', _retry(
+            lambda: ks_client.services.create(
+                name=name,
+                type=endpoint_type,
+                description=description)))
         print("Created service '{}' of type '{}'".format(name, endpoint_type))
 
-    for endpoint in _retry(lambda: ks_client.endpoints.list()):
-        if endpoint.service_id == service.id:
-            if endpoint.url == url:
-                if endpoint.interface == interface:
-                    return True
-            else:
-                _retry(lambda: ks_client.endpoints.delete(endpoint))
+    endpoints = snapshot.endpoints(service.id)
+    for endpoint in list(endpoints):
+        if endpoint.url == url:
+            if endpoint.interface == interface:
+                return True
+        else:
+            _retry(lambda: ks_client.endpoints.delete(endpoint))
+            endpoints.remove(endpoint)
 
-    _retry(lambda: ks_client.endpoints.create(region=region, service=service,
-                                              url=url, interface=interface))
+    endpoints.append(_retry(
+        lambda: ks_client.endpoints.create(region=region, service=service,
+                                           url=url, interface=interface)))
 
     print("Added service endpoint '{}' at '{}' (interface: '{}') "
           .format(name, url, interface))
@@ -226,18 +352,20 @@ def main(argv):
         'user_domain_id': 'default'
     }
 
+    start = time.time()
     auth_plugin = _get_auth_plugin(auth_url=url, **kwargs)
     session = _retry(lambda: ks_session.Session(auth=auth_plugin))
     ks_client = _retry(lambda: client.Client(session=session))
+    snapshot = KeystoneSnapshot(ks_client)
 
     projects = []
     for user in users:
         if 'project' in user and user['project'] not in projects:
             projects.append(user['project'])
 
-    add_projects(ks_client, projects)
-    add_users(ks_client, users)
-    add_user_roles(ks_client, users)
+    add_projects(snapshot, projects)
+    add_users(snapshot, users)
+    add_user_roles(snapshot, users)
 
     do_resolve = os.environ.get('KUBERNETES_RESOLVE_PUBLIC_ENDPOINTS', False)
 
@@ -255,10 +383,13 @@ def main(argv):
                         and interface['resolve']:
                     url = resolve_k8s_service_by_url(url)
 
-            add_service_endpoint(ks_client, e['name'], e['description'],
+            add_service_endpoint(snapshot, e['name'], e['description'],
                                  e['type'], url, e['region'],
                                  interface=interface_name)
 
+    print("Preload of {:d} users and {:d} services took {:.2f}s "
+          "({:d} workers)".format(len(users), len(data['endpoints']),
+                                  time.time() - start, PRELOAD_WORKERS))
     return 0
 
 
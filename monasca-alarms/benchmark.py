@@ -0,0 +1,184 @@
+#!/usr/bin/python
+# coding=utf-8
+
+# (c) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function
+'''
+Benchmarks MonascaLoadDefinitions against the in-process FakeMonascaAPI.
+
+For each definition count and change ratio the fake API is seeded with
+notifications and alarm definitions matching a generated definitions file,
+then the given fraction of the alarm definitions is modified in the file so
+the loader has to patch them. Wall time and API calls per run are reported.
+
+Requires python-monascaclient, like monasca_alarm_definition.py itself.
+'''
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+import monasca_alarm_definition
+
+# the fake API is shared by the benchmarks of all images
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'tools', 'fakes'))
+
+from fake_monasca_api import FakeMonascaAPI
+
+NOTIFICATION_COUNT = 10
+
+
+def _notifications():
+    return [{'name': 'notification-{:d}'.format(i),
+             'type': 'EMAIL',
+             'address': 'root+{:d}@localhost'.format(i)}
+            for i in range(NOTIFICATION_COUNT)]
+
+
+def _definitions(count):
+    definitions = []
+    for i in range(count):
+        action = 'notification-{:d}'.format(i % NOTIFICATION_COUNT)
+        definitions.append({
+            'name': 'definition-{:d}'.format(i),
+            'description': 'Benchmark alarm definition {:d}'.format(i),
+            'expression': 'cpu.idle_perc{{hostname=host-{:d}}} < 10'.format(i),
+            'match_by': ['hostname'],
+            'severity': 'HIGH',
+            'alarm_actions': [action],
+            'ok_actions': [action],
+            'undetermined_actions': [],
+        })
+    return definitions
+
+
+def _seed(api, notifications, definitions):
+    api.reset()
+    notification_ids = {}
+    for notification in notifications:
+        created = api.add('notification-methods', period=0, **notification)
+        notification_ids[created['name']] = created['id']
+
+    for definition in definitions:
+        seeded = dict(definition)
+        for field in ('alarm_actions', 'ok_actions', 'undetermined_actions'):
+            seeded[field] = [notification_ids[name] for name in definition[field]]
+        api.add('alarm-definitions', **seeded)
+
+
+def _apply_changes(definitions, ratio):
+    changed = int(round(len(definitions) * ratio))
+    modified = []
+    for i, definition in enumerate(definitions):
+        definition = dict(definition)
+        if i < changed:
+            definition['description'] += ' (changed)'
+        modified.append(definition)
+    return modified, changed
+
+
+def run_case(api, work_dir, count, ratio):
+    notifications = _notifications()
+    definitions = _definitions(count)
+    _seed(api, notifications, definitions)
+    definitions, changed = _apply_changes(definitions, ratio)
+
+    data_file = os.path.join(work_dir, 'definitions-{:d}.yml'.format(count))
+    with open(data_file, 'w') as f:
+        yaml.safe_dump({'notifications': notifications,
+                        'alarm_definitions': definitions}, f)
+
+    args = {
+        'keystone_token': 'benchmark',
+        'monasca_api_url': api.url,
+        'api_version': '2_0',
+        'verbose': False,
+    }
+    loader = monasca_alarm_definition.MonascaLoadDefinitions(args)
+
+    # Only count the calls made by the loader itself
+    before = api.total_calls()
+    start = time.time()
+    loader.run(data_file)
+    elapsed = time.time() - start
+
+    return {
+        'count': count,
+        'ratio': ratio,
+        'changed': changed,
+        'seconds': elapsed,
+        'calls': api.total_calls() - before,
+        'call_counts': api.call_counts(),
+    }
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        prog='benchmark',
+        description='Benchmark the alarm definition loader against a fake '
+                    'Monasca API')
+    parser.add_argument('--counts', default='100,1000,10000',
+                        help='Comma separated definition counts to load')
+    parser.add_argument('--ratios', default='0,0.1,0.5,1',
+                        help='Comma separated fractions of definitions to '
+                             'change between seeding and loading')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds of latency added to every API request')
+    parser.add_argument('--page-size', type=int, default=10000,
+                        help='Maximum elements per list page')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Print API calls per endpoint for each run')
+    return parser
+
+
+def main(args=None):
+    args = _get_parser().parse_args(args)
+
+    if not monasca_alarm_definition.monascaclient_found:
+        print("python-monascaclient>=1.6.0<1.7.0 is required", file=sys.stderr)
+        sys.exit(1)
+
+    counts = [int(c) for c in args.counts.split(',')]
+    ratios = [float(r) for r in args.ratios.split(',')]
+
+    api = FakeMonascaAPI(latency=args.latency, page_size=args.page_size)
+    api.start()
+    work_dir = tempfile.mkdtemp()
+    try:
+        print('{:>8} {:>6} {:>8} {:>10} {:>8}'.format(
+            'defs', 'ratio', 'changed', 'seconds', 'calls'))
+        for count in counts:
+            for ratio in ratios:
+                result = run_case(api, work_dir, count, ratio)
+                print('{count:>8d} {ratio:>6.2f} {changed:>8d} '
+                      '{seconds:>10.3f} {calls:>8d}'.format(**result))
+                if args.verbose:
+                    for call, n in sorted(result['call_counts'].items()):
+                        print('    {:<28} {:>8d}'.format(call, n))
+    finally:
+        api.stop()
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -131,8 +131,15 @@ alarm_definitions:
 
 
 import argparse
+import calendar
+import errno
+import hashlib
+import hmac
+import json
 import os
 import sys
+import tempfile
+import time
 import yaml
 
 monascaclient_found = False
@@ -157,20 +164,169 @@ except ImportError:
 else:
     monascaclient_found = True
 
+# Auth parameters that identify a distinct token/endpoint combination
+TOKEN_CACHE_KEY_ARGS = ['auth_url', 'username', 'password', 'project_id',
+                        'project_name', 'domain_id', 'domain_name',
+                        'service_type', 'endpoint_type', 'monasca_api_url']
+# Tokens this close to expiring are treated as already expired
+TOKEN_EXPIRY_MARGIN = 60
+# Random key of the cache file names, kept in the cache directory
+TOKEN_CACHE_SALT_FILE = 'salt'
+TOKEN_CACHE_SALT_SIZE = 32
+
+
+class TokenCache(object):
+    """On-disk cache of Keystone tokens and resolved Monasca API URLs
+
+    Entries are stored one file per set of auth parameters. The tokens are
+    stored as-is, so the cache directory and every file in it are only
+    readable by the owner. File names are an HMAC of the auth parameters
+    keyed with a random salt kept in the cache directory, so they can not
+    be used to guess the password offline without that salt.
+    """
+    def __init__(self, cache_dir, ttl):
+        self._cache_dir = os.path.expanduser(cache_dir)
+        self._ttl = ttl
+        self._salt = None
+
+    def _ensure_dir(self):
+        if not os.path.isdir(self._cache_dir):
+            os.makedirs(self._cache_dir, 0o700)
+
+    def _write_private(self, data):
+        """Write data to a new temporary file readable only by the owner
+
+        Returns the path of the file.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self._cache_dir, suffix='.tmp')
+        os.chmod(tmp_path, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return tmp_path
+
+    def _get_salt(self):
+        if self._salt is not None:
+            return self._salt
+
+        path = os.path.join(self._cache_dir, TOKEN_CACHE_SALT_FILE)
+        if not os.path.exists(path):
+            self._ensure_dir()
+            tmp_path = self._write_private(
+                os.urandom(TOKEN_CACHE_SALT_SIZE))
+            try:
+                # link rather than rename, so a salt created meanwhile by a
+                # concurrent run is never replaced
+                os.link(tmp_path, path)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            finally:
+                os.remove(tmp_path)
+
+        with open(path, 'rb') as f:
+            salt = f.read()
+        if len(salt) != TOKEN_CACHE_SALT_SIZE:
+            raise IOError('Invalid token cache salt: {}'.format(path))
+
+        self._salt = salt
+        return salt
+
+    def _key(self, args):
+        params = {arg: args.get(arg) for arg in TOKEN_CACHE_KEY_ARGS}
+        encoded = json.dumps(params, sort_keys=True).encode('utf-8')
+        return hmac.new(self._get_salt(), encoded, hashlib.sha256).hexdigest()
+
+    def _path(self, args):
+        return os.path.join(self._cache_dir, self._key(args) + '.json')
+
+    def get(self, args):
+        """Return (token, api_url) if a valid entry exists, else None
+        """
+        try:
+            with open(self._path(args)) as f:
+                entry = json.load(f)
+            token = entry['token']
+            api_url = entry['monasca_url']
+            expires = float(entry['expires'])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+        if expires - TOKEN_EXPIRY_MARGIN <= time.time():
+            return None
+        return token, api_url
+
+    def put(self, args, token, api_url, expires=None):
+        """Store an entry, written atomically so concurrent runs never see
+        a partial file
+        """
+        if expires is None:
+            expires = time.time() + self._ttl
+
+        entry = {'token': token, 'monasca_url': api_url, 'expires': expires}
+        try:
+            self._ensure_dir()
+            path = self._path(args)
+            tmp_path = self._write_private(json.dumps(entry).encode('utf-8'))
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as err:
+            # The cache is an optimization only, never fail the run over it
+            print('Unable to write token cache: {}'.format(err),
+                  file=sys.stderr)
+
+    def invalidate(self, args):
+        try:
+            os.remove(self._path(args))
+        except (IOError, OSError):
+            pass
+
+
+def _token_expiry(ks):
+    """Best effort lookup of the token expiry time from a KSClient
+
+    Returns seconds since the epoch, or None if it can not be determined.
+    """
+    kscl = getattr(ks, '_kscl', None) or getattr(ks, '_keystone', None)
+    auth_ref = getattr(kscl, 'auth_ref', None)
+    expires = getattr(auth_ref, 'expires', None)
+    if expires is None:
+        return None
+    return calendar.timegm(expires.utctimetuple())
+
+
+def _is_unauthorized(err):
+    for attr in ('code', 'status_code', 'http_status'):
+        if getattr(err, attr, None) == 401:
+            return True
+    return False
+
 
 class MonascaLoadDefinitions(object):
     """Loads Notifications and Alarm Definitions into Monasca
     """
-    def __init__(self, args):
+    def __init__(self, args, token_cache=None):
         self._args = args
         self._existing_notifications = None
         self._existing_alarm_definitions = None
         self._verbose = args['verbose']
+        self._token_cache = token_cache
+        self._token_from_cache = False
 
-    def _keystone_auth(self):
+    def _keystone_auth(self, use_cache=True):
         """Authenticate to Keystone and set self._token and self._api_url
+
+        When a token cache is configured and holds a valid entry for these
+        auth parameters, Keystone is not contacted at all.
         """
+        self._token_from_cache = False
         if not self._args['keystone_token']:
+            if use_cache and self._token_cache:
+                cached = self._token_cache.get(self._args)
+                if cached:
+                    self._token, self._api_url = cached
+                    self._token_from_cache = True
+                    self._print_message('Using cached Keystone token')
+                    return
+
             try:
                 ks = ksclient.KSClient(**self._args)
             except Exception as err:
@@ -181,6 +337,10 @@ class MonascaLoadDefinitions(object):
                 self._api_url = ks.monasca_url
             else:
                 self._api_url = self._args['monasca_api_url']
+
+            if self._token_cache:
+                self._token_cache.put(self._args, self._token, self._api_url,
+                                      _token_expiry(ks))
         else:
             if self._args['monasca_api_url'] is None:
                 raise Exception('Error: When specifying keystone_token, '
@@ -188,6 +348,23 @@ class MonascaLoadDefinitions(object):
             self._token = self._args['keystone_token']
             self._api_url = self._args['monasca_api_url']
 
+    def _connect(self):
+        self._keystone_auth()
+        self._monasca = client.Client(self._args['api_version'], self._api_url, token=self._token)
+        if self._token_from_cache:
+            # A cached token may have been revoked before its expiry, so
+            # check it once and fall back to a fresh authentication
+            try:
+                self._get_existing_notifications()
+            except Exception as err:
+                if not _is_unauthorized(err):
+                    raise
+                self._print_message('Cached Keystone token was rejected, re-authenticating')
+                self._token_cache.invalidate(self._args)
+                self._keystone_auth(use_cache=False)
+                self._monasca = client.Client(self._args['api_version'], self._api_url, token=self._token)
+        self._print_message('Using Monasca at {}'.format(self._api_url))
+
     def _get_existing_notifications(self):
         if self._existing_notifications is None:
             self._existing_notifications = self._monasca.notifications.list()
@@ -207,9 +384,7 @@ class MonascaLoadDefinitions(object):
 
         yaml_data = yaml.safe_load(yaml_text)
 
-        self._keystone_auth()
-        self._monasca = client.Client(self._args['api_version'], self._api_url, token=self._token)
-        self._print_message('Using Monasca at {}'.format(self._api_url))
+        self._connect()
         if 'notifications' not in yaml_data:
             raise Exception('No notifications section in {}'.format(data_file))
 
@@ -227,6 +402,76 @@ class MonascaLoadDefinitions(object):
             '{:d} Alarm Definitions Processed {:d} Alarm Definitions Changed'
             .format(processed, changed))
 
+    def export(self, data_file, page_size=1000):
+        """Write the existing Notifications and Alarm Definitions to data_file
+
+        The output uses the same format run() consumes. Notifications and
+        Alarm Definitions are sorted by name so exports of the same state are
+        identical. Definitions are serialized page by page as they arrive,
+        only their YAML text is kept until it is sorted and written.
+        """
+        self._connect()
+
+        notification_names = {}
+        notifications = []
+        for notification in self._list_pages(self._monasca.notifications, page_size):
+            notification_names[notification['id']] = notification['name']
+            notifications.append(_export_notification(notification))
+        notifications.sort(key=lambda n: n['name'])
+
+        directory = os.path.dirname(os.path.abspath(data_file))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('notifications:{}\n'.format('' if notifications else ' []'))
+                for notification in notifications:
+                    f.write(_yaml_list_item(notification))
+
+                exported = []
+                for definition in self._list_pages(self._monasca.alarm_definitions, page_size):
+                    exported.append((definition['name'], _yaml_list_item(
+                        _export_alarm_definition(definition, notification_names))))
+                exported.sort()
+
+                definitions = len(exported)
+                f.write('\nalarm_definitions:{}\n'.format('' if exported else ' []'))
+                for _, item in exported:
+                    f.write(item)
+            os.rename(tmp_path, data_file)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+        self._print_message(
+            '{:d} Notifications Exported {:d} Alarm Definitions Exported'
+            .format(len(notifications), definitions))
+
+    def _list_pages(self, manager, page_size):
+        """Yield every element of a collection, one page at a time
+
+        The Monasca API pages with an offset holding the id of the last
+        element of the previous page. The API may cap the limit below
+        page_size, so a short page does not mean the end was reached; paging
+        only stops once an empty page comes back. An API that ignores the
+        offset would return the same elements forever, so paging also stops
+        once a page contains an element already seen.
+        """
+        offset = None
+        seen = set()
+        while True:
+            kwargs = {'limit': page_size}
+            if offset is not None:
+                kwargs['offset'] = offset
+            page = manager.list(**kwargs)
+            if not page:
+                return
+            for element in page:
+                if element['id'] in seen:
+                    return
+                seen.add(element['id'])
+                yield element
+            offset = page[-1]['id']
+
     def _do_notifications(self, notifications):
         processed = 0
         changed = 0
@@ -372,6 +617,42 @@ class MonascaLoadDefinitions(object):
                 raise Exception(body)
 
 
+def _export_notification(notification):
+    exported = {'name': notification['name'],
+                'type': notification['type'],
+                'address': notification['address']}
+    if notification.get('period'):
+        exported['period'] = notification['period']
+    return exported
+
+
+def _export_alarm_definition(definition, notification_names):
+    exported = {'name': definition['name'],
+                'expression': definition['expression'],
+                'severity': definition.get('severity', 'LOW')}
+    if definition.get('description'):
+        exported['description'] = definition['description']
+    if definition.get('match_by'):
+        exported['match_by'] = definition['match_by']
+    for field in ['alarm_actions', 'ok_actions', 'undetermined_actions']:
+        actions = []
+        for notification_id in definition.get(field) or []:
+            if notification_id not in notification_names:
+                raise Exception('Alarm Definition "{}" references unknown Notification {}'.format(
+                    definition['name'], notification_id))
+            actions.append(notification_names[notification_id])
+        if actions:
+            exported[field] = sorted(actions)
+    return exported
+
+
+def _yaml_list_item(item):
+    """Render a single mapping as an indented YAML list entry
+    """
+    text = yaml.safe_dump([item], default_flow_style=False, allow_unicode=True)
+    return ''.join('  ' + line for line in text.splitlines(True))
+
+
 def _get_parser():
     parser = argparse.ArgumentParser(
         prog='monasca_alarm_definition',
@@ -525,6 +806,39 @@ def _get_parser():
     parser.add_argument('--definitions-file',
                         help='YAML file of Notifications and Alarm Definitions')
 
+    parser.add_argument('--export',
+                        default=False, action='store_true',
+                        help='Write the existing Notifications and Alarm '
+                        'Definitions to --definitions-file instead of '
+                        'loading it.')
+
+    parser.add_argument('--export-page-size',
+                        type=int, default=1000,
+                        help='Number of elements requested per page when '
+                        'exporting.')
+
+    parser.add_argument('--token-cache-dir',
+                        default=_env('MONASCA_TOKEN_CACHE_DIR',
+                                     default='~/.cache/monasca-alarms'),
+                        help='Directory for cached Keystone tokens. Defaults '
+                        'to env[MONASCA_TOKEN_CACHE_DIR] or '
+                        '~/.cache/monasca-alarms')
+
+    parser.add_argument('--token-cache-ttl',
+                        type=int,
+                        default=int(_env('MONASCA_TOKEN_CACHE_TTL',
+                                         default='3600')),
+                        help='Seconds to keep a cached token when Keystone '
+                        'does not report its expiry. Defaults to '
+                        'env[MONASCA_TOKEN_CACHE_TTL] or 3600')
+
+    parser.add_argument('--token-cache',
+                        default=_env('MONASCA_TOKEN_CACHE',
+                                     default='false').lower() == 'true',
+                        action='store_true',
+                        help='Cache Keystone tokens on disk between runs. '
+                        'Defaults to env[MONASCA_TOKEN_CACHE] or false')
+
     return parser
 
 
@@ -589,9 +903,16 @@ def main(args=None):
     if not args.definitions_file:
         raise Exception('--definitions-file argument is required')
 
-    definition = MonascaLoadDefinitions(kwargs)
+    token_cache = None
+    if args.token_cache and not args.os_auth_token:
+        token_cache = TokenCache(args.token_cache_dir, args.token_cache_ttl)
+
+    definition = MonascaLoadDefinitions(kwargs, token_cache)
 
-    definition.run(args.definitions_file)
+    if args.export:
+        definition.export(args.definitions_file, args.export_page_size)
+    else:
+        definition.run(args.definitions_file)
 
 
 if __name__ == "__main__":
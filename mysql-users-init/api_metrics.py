@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Lightweight latency recording for the API calls made by the init jobs.
+
+Disabled unless `API_METRICS=true`. When enabled, every recorded operation
+keeps its individual latencies so count, total and p50/p95/p99 can be
+reported when the job ends, either as a table in the log or as JSON written
+to `API_METRICS_FILE`.
+"""
+
+import functools
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+ENABLED = os.environ.get('API_METRICS', 'false').lower() == 'true'
+METRICS_FILE = os.environ.get('API_METRICS_FILE', None)
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(ordered, pct):
+    """
+    :param ordered: sorted list of samples
+    :param pct: percentile, 0-100
+    :return: the nearest-rank percentile of the samples
+    """
+    if not ordered:
+        return 0.0
+
+    rank = int(math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+class Metrics(object):
+    """Latency samples in seconds per operation, thread-safe."""
+
+    def __init__(self):
+        self._samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, operation, seconds):
+        with self._lock:
+            self._samples[operation].append(seconds)
+
+    def summary(self):
+        """
+        :return: dict of operation -> count, total, p50, p95 and p99
+        """
+        with self._lock:
+            samples = {op: sorted(s) for op, s in self._samples.items()}
+
+        return {op: {'count': len(s),
+                     'total': sum(s),
+                     'p50': percentile(s, 50),
+                     'p95': percentile(s, 95),
+                     'p99': percentile(s, 99)}
+                for op, s in samples.items()}
+
+
+metrics = Metrics()
+
+
+def record(operation, seconds):
+    if ENABLED:
+        metrics.record(operation, seconds)
+
+
+@contextmanager
+def timed(operation):
+    if not ENABLED:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        metrics.record(operation, time.time() - start)
+
+
+def instrument_methods(obj, prefix, names):
+    """
+    Replaces the named methods of `obj` (where present) with timed wrappers
+    recorded as `<prefix>.<name>`. Does nothing unless metrics are enabled.
+    """
+    if not ENABLED:
+        return obj
+
+    for name in names:
+        method = getattr(obj, name, None)
+        if method is None or not callable(method):
+            continue
+
+        def wrap(method, operation):
+            @functools.wraps(method)
+            def timed_method(*args, **kwargs):
+                with timed(operation):
+                    return method(*args, **kwargs)
+            return timed_method
+
+        setattr(obj, name, wrap(method, '{}.{}'.format(prefix, name)))
+
+    return obj
+
+
+def report(log=logger):
+    """Logs the summary table, and writes it as JSON if configured."""
+    if not ENABLED:
+        return
+
+    summary = metrics.summary()
+    if METRICS_FILE:
+        with open(METRICS_FILE, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+        log.info('wrote API metrics to %s', METRICS_FILE)
+
+    if not summary:
+        log.info('no API calls were recorded')
+        return
+
+    width = max(len(op) for op in summary)
+    log.info('%-*s %7s %9s %8s %8s %8s', width, 'operation', 'count',
+             'total(s)', 'p50(ms)', 'p95(ms)', 'p99(ms)')
+    for op, s in sorted(summary.items(), key=lambda i: -i[1]['total']):
+        log.info('%-*s %7d %9.3f %8.1f %8.1f %8.1f', width, op, s['count'],
+                 s['total'], s['p50'] * 1000, s['p95'] * 1000,
+                 s['p99'] * 1000)
@@ -12,14 +12,22 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from __future__ import print_function
+
+import copy
 import json
 import os
+import socket
+import threading
+import time
 
 import dpath.util
 import requests
 import yaml
 
 from dotmap import DotMap
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
 
 CACERT_PATH = '/var/run/secrets/kubernetes.io/serviceaccount/ca.crt'
 TOKEN_PATH = '/var/run/secrets/kubernetes.io/serviceaccount/token'
@@ -31,6 +39,24 @@ KUBERNETES_SERVICE_PORT = os.environ.get('KUBERNETES_SERVICE_PORT', '443')
 KUBERNETES_API_URL = "https://{}:{}".format(KUBERNETES_SERVICE_HOST, KUBERNETES_SERVICE_PORT)
 
 DEFAULT_TIMEOUT = 10
+DEFAULT_WATCH_TIMEOUT = int(os.environ.get('KUBERNETES_WATCH_TIMEOUT', '300'))
+WATCH_MAX_FAILURES = 5
+DEFAULT_LIST_LIMIT = int(os.environ.get('KUBERNETES_LIST_LIMIT', '500'))
+LIST_MAX_RESTARTS = 3
+
+# optional caching of GET responses, see ResponseCache
+RESPONSE_CACHE = os.environ.get('KUBERNETES_RESPONSE_CACHE',
+                                'false').lower() == 'true'
+DEFAULT_CACHE_TTL = float(os.environ.get('KUBERNETES_CACHE_TTL', '60'))
+
+# client-side throttling and connection tuning, see RateLimiter and
+# KeepAliveAdapter; a QPS of 0 (the default) disables throttling
+QPS = float(os.environ.get('KUBERNETES_QPS', '0'))
+BURST = int(os.environ.get('KUBERNETES_BURST', '100'))
+POOL_SIZE = int(os.environ.get('KUBERNETES_POOL_SIZE', '10'))
+KEEPALIVE = os.environ.get('KUBERNETES_KEEPALIVE', 'true').lower() == 'true'
+KEEPALIVE_IDLE = int(os.environ.get('KUBERNETES_KEEPALIVE_IDLE', '30'))
+GZIP = os.environ.get('KUBERNETES_GZIP', 'true').lower() == 'true'
 
 
 def load_current_kube_credentials():
@@ -57,14 +83,176 @@ class KubernetesAPIError(Exception):
     pass
 
 
-class KubernetesAPIResponse(DotMap):
+def shutdown_response(res):
+    """
+    Shuts down the connection of a streaming response, so a thread blocked
+    reading it wakes up with a connection error.
+    """
+    connection = getattr(res.raw, '_connection', None)
+    sock = getattr(connection, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            # already closed
+            pass
+
+
+def _wrap(value):
+    if type(value) is dict:
+        return LazyDict(value)
+    if type(value) is list:
+        return LazyList(value)
+    return value
+
+
+class LazyDict(dict):
+    """
+    Attribute and item access over a decoded JSON object. Unlike DotMap,
+    nested objects and lists are only wrapped when they are accessed, so
+    large responses cost nothing until they are read.
+
+    Being a dict, it can be passed to `json.dumps()` as-is. As with DotMap,
+    a missing key reads as an empty LazyDict, which is added to its parent
+    once something is written to it. `toDict()` returns a plain dict.
+    """
+
+    __slots__ = ('_parent', '_key')
+
+    def __init__(self, data=None, parent=None, key=None):
+        super(LazyDict, self).__init__(data or ())
+        object.__setattr__(self, '_parent', parent)
+        object.__setattr__(self, '_key', key)
+
+    def _attach(self):
+        # a missing key read earlier becomes real on the first write
+        parent = self._parent
+        if parent is not None:
+            parent._attach()
+            dict.setdefault(parent, self._key, self)
+            object.__setattr__(self, '_parent', None)
+
+    def __getitem__(self, key):
+        try:
+            value = dict.__getitem__(self, key)
+        except KeyError:
+            return LazyDict(parent=self, key=key)
+
+        wrapped = _wrap(value)
+        if wrapped is not value:
+            # keep the wrapper so changes made through it are not lost
+            dict.__setitem__(self, key, wrapped)
+        return wrapped
+
+    def __setitem__(self, key, value):
+        self._attach()
+        dict.__setitem__(self, key, value)
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in LazyDict.__slots__:
+            raise AttributeError(name)
+
+        return self[name]
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+    def __delattr__(self, name):
+        try:
+            del self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return dict.pop(self, key, *default)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, dict.__repr__(self))
+
+    def __reduce__(self):
+        return LazyDict, (dict(self),)
+
+    def toDict(self):
+        return dict(self)
+
+    def pprint(self):
+        print(json.dumps(self, indent=4, sort_keys=True, default=str))
+
+
+class LazyList(list):
+    """A decoded JSON list whose items are wrapped on access, see `LazyDict`."""
+
+    __slots__ = ()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return LazyList(list.__getitem__(self, index))
+
+        value = list.__getitem__(self, index)
+        wrapped = _wrap(value)
+        if wrapped is not value:
+            list.__setitem__(self, index, wrapped)
+        return wrapped
+
+    def __getslice__(self, i, j):
+        # python 2 slices lists without calling __getitem__
+        return self.__getitem__(slice(max(0, i), max(0, j)))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def pop(self, index=-1):
+        value = self[index]
+        del self[index]
+        return value
+
+    def __repr__(self):
+        return 'LazyList({})'.format(list.__repr__(self))
+
+    def __reduce__(self):
+        return LazyList, (list(self),)
+
 
-    def __init__(self, response, decoded=None):
-        super(KubernetesAPIResponse, self).__init__(decoded, _dynamic=False)
-        self.response = response
+class KubernetesAPIResponse(LazyDict):
+
+    __slots__ = ('response',)
+
+    def __init__(self, response=None, decoded=None):
+        super(KubernetesAPIResponse, self).__init__(decoded)
+        object.__setattr__(self, 'response', response)
+
+    def __getattr__(self, name):
+        if name == 'response':
+            raise AttributeError(name)
+
+        return super(KubernetesAPIResponse, self).__getattr__(name)
+
+    def __reduce__(self):
+        return KubernetesAPIResponse, (self.response, dict(self))
 
     def get(self, glob, separator="/"):
-        return dpath.util.get(self, glob, separator)
+        return _wrap(dpath.util.get(self, glob, separator))
 
     def search(self, glob, yielded=False, separator="/", afilter=None, dirs=True):
         return dpath.util.search(self, glob, yielded, separator, afilter, dirs)
@@ -80,12 +268,156 @@ class KubernetesAPIResponse(DotMap):
         return self.response.status_code
 
 
+class ResponseCache(object):
+    """
+    Decoded GET responses keyed by path and params. Watches and paged
+    lists are not cached.
+
+    Entries younger than `ttl` seconds are served without a request. Older
+    ones are revalidated with If-None-Match when the server sent an ETag, and
+    a 304 Not Modified reply serves the cached body again; without an ETag
+    they are simply fetched again. Any write to a path drops the cached
+    entries for it, its collection and its children.
+    """
+
+    def __init__(self, ttl=DEFAULT_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(path, params):
+        return path, tuple(sorted((k, str(v)) for k, v in (params or {}).items()))
+
+    def get(self, key):
+        """:return: (entry, fresh) where entry is None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, False
+            return entry, time.time() - entry['stored_at'] < self.ttl
+
+    def put(self, key, response, body):
+        with self._lock:
+            self._entries[key] = {
+                'response': response,
+                'body': body,
+                'etag': response.headers.get('ETag'),
+                'stored_at': time.time()
+            }
+
+    def touch(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries[key]['stored_at'] = time.time()
+
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def invalidate(self, path):
+        path = path.rstrip('/')
+        collection = path.rsplit('/', 1)[0]
+        with self._lock:
+            stale = [key for key in self._entries
+                     if key[0] in (path, collection)
+                     or key[0].startswith(path + '/')]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'revalidated': self.revalidated,
+                    'invalidations': self.invalidations,
+                    'entries': len(self._entries)}
+
+
+class RateLimiter(object):
+    """
+    Token bucket allowing `qps` requests per second on average, with bursts
+    of up to `burst`. Shared by all threads using a client.
+    """
+
+    def __init__(self, qps, burst):
+        self.qps = float(qps)
+        self.burst = max(1, int(burst))
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be made."""
+        if self.qps <= 0:
+            return
+
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._updated) * self.qps)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.qps
+
+            time.sleep(wait)
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """An HTTPAdapter that enables TCP keep-alive on pooled connections."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        options = list(HTTPConnection.default_socket_options)
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,
+                            KEEPALIVE_IDLE))
+        if hasattr(socket, 'TCP_KEEPINTVL'):
+            options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL,
+                            KEEPALIVE_IDLE))
+        kwargs['socket_options'] = options
+        super(KeepAliveAdapter, self).init_poolmanager(*args, **kwargs)
+
+
 class KubernetesAPIClient(object):
-    def __init__(self, verify=True):
+    def __init__(self, verify=True, cache=None, qps=QPS, burst=BURST,
+                 pool_size=POOL_SIZE):
         self.session = requests.Session()
         self.session.verify = verify
         self.api_url = None
 
+        if KEEPALIVE:
+            adapter = KeepAliveAdapter(pool_connections=pool_size,
+                                       pool_maxsize=pool_size)
+        else:
+            adapter = HTTPAdapter(pool_connections=pool_size,
+                                  pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        # requests decompresses transparently, so this only affects what is
+        # sent over the wire
+        self.session.headers['Accept-Encoding'] = \
+            'gzip, deflate' if GZIP else 'identity'
+
+        self.limiter = RateLimiter(qps, burst)
+
+        if cache is None:
+            cache = RESPONSE_CACHE
+        self.cache = ResponseCache() if cache else None
+
+        # if set, called with ('METHOD /path/{template}', seconds) after
+        # every request
+        self.observer = None
+
     def load_cluster_config(self):
         self.session.verify = CACERT_PATH
 
@@ -118,22 +450,76 @@ class KubernetesAPIClient(object):
 
     def request(self, method, path, *args, **kwargs):
         raise_for_status = kwargs.pop('raise_for_status', True)
+        raw = kwargs.pop('raw', False)
         timeout = kwargs.pop('timeout', DEFAULT_TIMEOUT)
+        # cache=False always asks the API server, and leaves the cache alone
+        use_cache = kwargs.pop('cache', True)
 
+        operation = '{} {}'.format(method, path)
         if args:
             path = path.format(*args)
 
+        cache_key = None
+        entry = None
+        if self.cache is not None and use_cache and method == 'GET' \
+                and not kwargs.get('stream'):
+            params = kwargs.get('params') or {}
+            # only unpaged GETs are cached: a first page revalidated with a
+            # 304 would come back with a continue token that has expired
+            if not any(p in params for p in ('watch', 'limit', 'continue')):
+                cache_key = ResponseCache.key(path, params)
+                entry, fresh = self.cache.get(cache_key)
+                if fresh:
+                    self.cache.count('hits')
+                    return self._cached(entry, raw)
+
+                if entry is not None and entry['etag']:
+                    headers = dict(kwargs.pop('headers', None) or {})
+                    headers['If-None-Match'] = entry['etag']
+                    kwargs['headers'] = headers
+
         slash = '' if path.startswith('/') else '/'
+        self.limiter.acquire()
+        start = time.time()
         res = self.session.request(
             method,
             '{}{}{}'.format(self.api_url, slash, path),
             timeout=timeout,
             **kwargs)
 
+        if self.observer is not None:
+            self.observer(operation, time.time() - start)
+
+        if self.cache is not None and method != 'GET':
+            self.cache.invalidate(path)
+
+        if entry is not None and res.status_code == 304:
+            self.cache.count('revalidated')
+            self.cache.touch(cache_key)
+            return self._cached(entry, raw)
+
         if raise_for_status:
             res.raise_for_status()
 
-        return KubernetesAPIResponse(res, res.json())
+        body = res.json()
+        if cache_key is not None and res.status_code == 200:
+            self.cache.count('misses')
+            self.cache.put(cache_key, res, body)
+            body = copy.deepcopy(body)
+
+        if raw:
+            # fast path for callers that only need the decoded body
+            return body
+
+        return KubernetesAPIResponse(res, body)
+
+    def _cached(self, entry, raw):
+        # callers may modify what they get, so never hand out the cached copy
+        body = copy.deepcopy(entry['body'])
+        if raw:
+            return body
+
+        return KubernetesAPIResponse(entry['response'], body)
 
     def get(self, path, *args, **kwargs):
         kwargs.setdefault('allow_redirects', True)
@@ -148,6 +534,201 @@ class KubernetesAPIClient(object):
     def patch(self, path, *args, **kwargs):
         return self.request('PATCH', path, *args, **kwargs)
 
+    def list_iter(self, path, *args, **kwargs):
+        """
+        Iterates over the items of a collection, fetching `limit` items per
+        request using continue tokens, so large collections are never held
+        in memory at once.
+
+        If a continue token expires (410 Gone) before the listing finishes,
+        the collection is listed again from the start and items already
+        yielded (by uid) are skipped. Pages are never served from the
+        response cache.
+
+        :param limit: items per page
+        :param label_selector: optional label selector, e.g. 'app=foo'
+        :param field_selector: optional field selector,
+                               e.g. 'status.phase=Succeeded'
+        :param raw: yield decoded dicts rather than LazyDict objects
+        """
+        limit = kwargs.pop('limit', DEFAULT_LIST_LIMIT)
+        label_selector = kwargs.pop('label_selector', None)
+        field_selector = kwargs.pop('field_selector', None)
+        raw = kwargs.pop('raw', False)
+        kwargs.pop('raise_for_status', None)
+        kwargs['cache'] = False
+
+        params = dict(kwargs.pop('params', None) or {})
+        params['limit'] = limit
+        if label_selector:
+            params['labelSelector'] = label_selector
+        if field_selector:
+            params['fieldSelector'] = field_selector
+
+        seen = set()
+        restarts = 0
+        while True:
+            res = self.request('GET', path, *args, params=params,
+                               raise_for_status=False, **kwargs)
+            if res.status_code == 410 and 'continue' in params:
+                restarts += 1
+                if restarts > LIST_MAX_RESTARTS:
+                    res.response.raise_for_status()
+
+                del params['continue']
+                continue
+
+            res.response.raise_for_status()
+            body = res.toDict()
+            for item in body.get('items') or []:
+                uid = item.get('metadata', {}).get('uid')
+                if uid is not None:
+                    if uid in seen:
+                        continue
+                    seen.add(uid)
+
+                yield item if raw else _wrap(item)
+
+            token = body.get('metadata', {}).get('continue')
+            if not token:
+                return
+
+            params['continue'] = token
+
+    def watch(self, path, *args, **kwargs):
+        """
+        Streams watch events for a collection as (type, object) tuples,
+        where type is ADDED, MODIFIED or DELETED.
+
+        The last seen resourceVersion (including from BOOKMARK events) is
+        remembered, and the watch is resumed from it whenever the server
+        ends the stream or the connection times out. If that version has
+        expired (410 Gone), the collection is re-listed and every current
+        object is yielded again as ADDED, so callers should handle repeated
+        events idempotently.
+
+        :param resource_version: version to start from; if None the server
+                                 first sends ADDED events for every existing
+                                 object
+        :param timeout_seconds: server-side duration of each watch request
+        :param deadline: seconds after which the generator stops, or None to
+                         watch until the caller stops iterating
+        :param raw: yield decoded dicts rather than LazyDict objects
+        :param stop: optional threading.Event; once set, the generator ends
+                     at the next line received or before reconnecting
+        :param on_response: called with each streaming response as it is
+                            opened, e.g. so another thread can wake this one
+                            with shutdown_response() after setting `stop`
+        """
+        resource_version = kwargs.pop('resource_version', None)
+        timeout_seconds = kwargs.pop('timeout_seconds', DEFAULT_WATCH_TIMEOUT)
+        deadline = kwargs.pop('deadline', None)
+        raw = kwargs.pop('raw', False)
+        stop = kwargs.pop('stop', None)
+        on_response = kwargs.pop('on_response', None)
+        params = dict(kwargs.pop('params', None) or {})
+
+        def stopped():
+            return stop is not None and stop.is_set()
+
+        operation = 'WATCH {}'.format(path)
+        if args:
+            path = path.format(*args)
+
+        slash = '' if path.startswith('/') else '/'
+        url = '{}{}{}'.format(self.api_url, slash, path)
+        give_up_at = None if deadline is None else time.time() + deadline
+        failures = 0
+
+        while not stopped() and \
+                (give_up_at is None or time.time() < give_up_at):
+            watch_params = dict(params)
+            watch_params['watch'] = 'true'
+            watch_params['allowWatchBookmarks'] = 'true'
+            watch_params['timeoutSeconds'] = str(int(timeout_seconds))
+            if give_up_at is not None:
+                watch_params['timeoutSeconds'] = str(max(1, min(
+                    int(timeout_seconds), int(give_up_at - time.time()))))
+            if resource_version is not None:
+                watch_params['resourceVersion'] = resource_version
+
+            self.limiter.acquire()
+            start = time.time()
+            res = None
+            expired = False
+            try:
+                res = self.session.get(
+                    url, params=watch_params, stream=True,
+                    timeout=(DEFAULT_TIMEOUT,
+                             int(watch_params['timeoutSeconds']) +
+                             DEFAULT_TIMEOUT),
+                    **kwargs)
+                if on_response is not None:
+                    on_response(res)
+                    if stopped():
+                        return
+                if self.observer is not None:
+                    self.observer(operation, time.time() - start)
+                res.raise_for_status()
+
+                for line in res.iter_lines(chunk_size=None):
+                    if stopped():
+                        return
+
+                    if not line:
+                        continue
+
+                    event = json.loads(line.decode('utf-8'))
+                    event_type = event.get('type')
+                    obj = event.get('object') or {}
+                    if event_type == 'ERROR':
+                        if obj.get('code') == 410:
+                            expired = True
+                            break
+
+                        raise KubernetesAPIError(
+                            'watch on {} failed: {}'.format(
+                                path, obj.get('message')))
+
+                    version = obj.get('metadata', {}).get('resourceVersion')
+                    if version:
+                        resource_version = version
+
+                    if event_type == 'BOOKMARK':
+                        continue
+
+                    failures = 0
+                    yield event_type, (obj if raw else _wrap(obj))
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError):
+                if stopped():
+                    return
+
+                # resume from the last seen version
+                failures += 1
+                if failures > WATCH_MAX_FAILURES:
+                    raise
+
+                time.sleep(min(DEFAULT_TIMEOUT, 2 ** failures * 0.1))
+                continue
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code != 410:
+                    raise
+                expired = True
+            finally:
+                if res is not None:
+                    res.close()
+
+            if expired:
+                # the version is too old to resume from, start over from a
+                # fresh listing
+                listing = self.request('GET', path, params=params, raw=True,
+                                       cache=False, **kwargs)
+                resource_version = listing['metadata'].get('resourceVersion')
+                for obj in listing.get('items') or []:
+                    yield 'ADDED', (obj if raw else _wrap(obj))
+
     def json_patch(self, ops, path, *args, **kwargs):
         if kwargs.get('allow_redirects') is True:
             raise ValueError('Patch is not compatible with redirects!')
@@ -19,9 +19,8 @@ import logging
 import os
 import random
 import string
-import time
 
-from typing import (List, Dict, Union, Sequence, Iterable, Set,
+from typing import (List, Dict, Union, Sequence, Iterable, Set, Tuple,
                     TypeVar, Callable, Optional, Any)
 
 import pymysql
@@ -33,12 +32,17 @@ from pymysql.err import OperationalError
 from requests import HTTPError
 from requests import RequestException
 
+import api_metrics
+import retry_policy
+
 from kubernetes import KubernetesAPIClient, KubernetesAPIResponse
 
 PASSWORD_CHARACTERS = string.ascii_letters + string.digits
 
 PRELOAD_PATH = os.environ.get('PRELOAD_PATH', '/preload.yml')
 NAMESPACE_FILE = '/var/run/secrets/kubernetes.io/serviceaccount/namespace'
+SECRET_LIST = os.environ.get('SECRET_LIST', 'false').lower() == 'true'
+SECRET_LIST_LIMIT = int(os.environ.get('SECRET_LIST_LIMIT', '500'))
 
 LOG_LEVEL = logging.getLevelName(os.environ.get('LOG_LEVEL', 'INFO'))
 logging.basicConfig(level=LOG_LEVEL)
@@ -60,29 +64,16 @@ class MySQLInitException(Exception):
     pass
 
 
+def log_response(exc: Exception):
+    response = getattr(exc, 'response', None)
+    if isinstance(exc, RequestException) and response is not None:
+        logger.debug('Response was: %r', response.text)
+
+
 def retry(retries=5, delay=2.0,
           exc_types=(OperationalError, RequestException)):
-
-    def decorator(func):
-        def f_retry(*args, **kwargs):
-            for i in range(retries):
-                try:
-                    return func(*args, **kwargs)
-                except exc_types as exc:
-                    if i < retries - 1:
-                        logger.info('%s failed (attempt %d of %d)',
-                                    func.__name__, i + 1, retries)
-                        logger.debug('Caught exception, retrying...',
-                                     exc_info=True)
-                        time.sleep(delay)
-                    else:
-                        logger.exception('Failed after %d attempts', retries)
-                        if isinstance(exc, RequestException):
-                            logger.debug('Response was: %r', exc.response.text)
-
-                        raise
-        return f_retry
-    return decorator
+    return retry_policy.retry(retries=retries, delay=delay,
+                              exc_types=exc_types, on_failure=log_response)
 
 
 def get_current_namespace() -> str:
@@ -104,6 +95,8 @@ def get_kubernetes_client() -> KubernetesAPIClient:
     if _kubernetes_client is None:
         _kubernetes_client = KubernetesAPIClient()
         _kubernetes_client.load_auto_config()
+        if api_metrics.ENABLED:
+            _kubernetes_client.observer = api_metrics.record
 
     return _kubernetes_client
 
@@ -113,13 +106,27 @@ def generate_password(length=16) -> str:
     return ''.join(r.choice(PASSWORD_CHARACTERS) for _ in range(length))
 
 
+class InstrumentedCursor(pymysql.cursors.DictCursor):
+    """A DictCursor recording the latency of each statement by type."""
+
+    def execute(self, query, args=None):
+        statement = ' '.join(query.split()[:2]).upper().rstrip(';')
+        with api_metrics.timed('mysql {}'.format(statement)):
+            return super().execute(query, args)
+
+
 @retry(retries=10, delay=5.0)
 def get_mysql_client() -> Connection:
+    if api_metrics.ENABLED:
+        cursorclass = InstrumentedCursor
+    else:
+        cursorclass = pymysql.cursors.DictCursor
+
     return pymysql.connect(host=os.environ.get('MYSQL_INIT_HOST'),
                            port=int(os.environ.get('MYSQL_INIT_PORT', '3306')),
                            user=os.environ.get('MYSQL_INIT_USERNAME'),
                            password=os.environ.get('MYSQL_INIT_PASSWORD'),
-                           cursorclass=pymysql.cursors.DictCursor,
+                           cursorclass=cursorclass,
                            charset='utf8mb4',
                            sql_mode='NO_AUTO_CREATE_USER')
 
@@ -157,6 +164,109 @@ def ensure_kubernetes_namespace(client: KubernetesAPIClient, namespace: str):
 
 
 @retry()
+def list_kubernetes_secrets(
+        client: KubernetesAPIClient,
+        namespace: str) -> Optional[List[KubernetesAPIResponse]]:
+    """
+    Lists all secrets in a namespace, in pages of SECRET_LIST_LIMIT.
+
+    :return: the secrets, or None if listing them is forbidden
+    """
+    try:
+        return list(client.list_iter('/api/v1/namespaces/{}/secrets',
+                                     namespace, limit=SECRET_LIST_LIMIT))
+    except HTTPError as err:
+        if err.response.status_code != 403:
+            raise
+
+        return None
+
+
+@retry()
+def read_kubernetes_secret(client: KubernetesAPIClient, namespace: str,
+                           name: str) -> Optional[KubernetesAPIResponse]:
+    """
+    :return: the secret, or None if it does not exist
+    """
+    try:
+        return client.get('/api/v1/namespaces/{}/secrets/{}', namespace, name)
+    except HTTPError as err:
+        if err.response.status_code != 404:
+            raise
+
+        return None
+
+
+class SecretCache:
+    """
+    Kubernetes secrets indexed by (namespace, name), updated as secrets are
+    written so every later read is served from memory. Secrets are read one by
+    one unless SECRET_LIST is set, in which case each namespace is listed once,
+    on first access; a namespace the job may not list falls back to reading
+    secrets one by one. Namespaces known to exist are remembered too.
+    """
+
+    def __init__(self, list_namespaces: bool=None):
+        if list_namespaces is None:
+            list_namespaces = SECRET_LIST
+
+        self._list_namespaces = list_namespaces
+        # a cached None records a secret known not to exist
+        self._secrets = \
+            {}  # type: Dict[Tuple[str, str], Optional[KubernetesAPIResponse]]
+        self._listed = {}  # type: Dict[str, bool]
+        self._namespaces = set()  # type: Set[str]
+
+    def _list(self, client: KubernetesAPIClient, namespace: str):
+        if namespace in self._listed:
+            return
+
+        secrets = list_kubernetes_secrets(client, namespace)
+        self._listed[namespace] = secrets is not None
+        if secrets is None:
+            logger.warning('not allowed to list secrets in namespace "%s", '
+                           'reading them one by one', namespace)
+            return
+
+        for secret in secrets:
+            self._secrets.setdefault((namespace, secret.metadata.name), secret)
+
+        # an empty list doesn't prove the namespace exists, the API returns
+        # one for unknown namespaces too
+        if secrets:
+            self._namespaces.add(namespace)
+
+    def get(self, client: KubernetesAPIClient, namespace: str,
+            name: str) -> Optional[KubernetesAPIResponse]:
+        key = (namespace, name)
+        if self._list_namespaces:
+            self._list(client, namespace)
+
+        if key in self._secrets or self._listed.get(namespace):
+            return self._secrets.get(key)
+
+        secret = read_kubernetes_secret(client, namespace, name)
+        if secret is not None:
+            self._namespaces.add(namespace)
+
+        self._secrets[key] = secret
+        return secret
+
+    def put(self, namespace: str, name: str, secret: KubernetesAPIResponse):
+        self._secrets[(namespace, name)] = secret
+        self._namespaces.add(namespace)
+
+    def ensure_namespace(self, client: KubernetesAPIClient, namespace: str):
+        if namespace in self._namespaces:
+            return
+
+        ensure_kubernetes_namespace(client, namespace)
+        self._namespaces.add(namespace)
+
+
+_secret_cache = SecretCache()
+
+
 def get_kubernetes_secret(name: str,
                           namespace: str=None) -> Union[KubernetesAPIResponse,
                                                         None]:
@@ -168,13 +278,7 @@ def get_kubernetes_secret(name: str,
     if namespace is None:
         namespace = get_current_namespace()
 
-    try:
-        return client.get('/api/v1/namespaces/{}/secrets/{}', namespace, name)
-    except HTTPError as e:
-        if e.response.status_code != 404:
-            raise
-
-        return None
+    return _secret_cache.get(client, namespace, name)
 
 
 def create_kubernetes_secret(fields: Dict[str, str],
@@ -194,7 +298,7 @@ def create_kubernetes_secret(fields: Dict[str, str],
     if namespace is None:
         namespace = get_current_namespace()
 
-    ensure_kubernetes_namespace(client, namespace)
+    _secret_cache.ensure_namespace(client, namespace)
 
     def prep(value):
         return base64.b64encode(value.encode('utf-8')).decode('utf-8')
@@ -217,12 +321,15 @@ def create_kubernetes_secret(fields: Dict[str, str],
     if replace:
         logger.info('replacing secret "%s" in namespace "%s"',
                     name, namespace)
-        return client.request('PUT', '/api/v1/namespaces/{}/secrets/{}',
-                              namespace, name, json=secret)
+        result = client.request('PUT', '/api/v1/namespaces/{}/secrets/{}',
+                                namespace, name, json=secret)
     else:
         logger.info('creating secret "%s" in namespace "%s"', name, namespace)
-        return client.post('/api/v1/namespaces/{}/secrets',
-                           namespace, json=secret)
+        result = client.post('/api/v1/namespaces/{}/secrets',
+                             namespace, json=secret)
+
+    _secret_cache.put(namespace, name, result)
+    return result
 
 
 def diff_kubernetes_secret(secret: KubernetesAPIResponse,
@@ -491,7 +598,7 @@ def load_databases(client: Connection,
             load_grant(client, name, grant_cfg, known_hosts)
 
 
-def main():
+def run():
     mysql = get_mysql_client()
 
     with open(PRELOAD_PATH, 'r') as f:
@@ -514,5 +621,18 @@ def main():
 
         logger.info('done')
 
+
+def main():
+    try:
+        run()
+    finally:
+        retry_policy.log_stats(logger)
+        api_metrics.report(logger)
+        if _kubernetes_client is not None \
+                and _kubernetes_client.cache is not None:
+            logger.info('kubernetes response cache: %r',
+                        _kubernetes_client.cache.stats())
+
+
 if __name__ == '__main__':
     main()
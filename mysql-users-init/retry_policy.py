@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Retry policy shared by the init jobs.
+
+Delays grow exponentially from the base `delay` up to `max_delay`, and each
+sleep is drawn uniformly from [0, current delay] ("full jitter") so jobs that
+start together after a cluster restart spread out instead of retrying in
+lockstep. Each decorated call makes up to `retries` attempts. Optionally a
+call may also be given a deadline on the time spent waiting between attempts
+(RETRY_DEADLINE by default), and all calls in the process may share a retry
+budget (RETRY_BUDGET), so a dead dependency fails the job quickly rather than
+through a long chain of nested retries.
+
+Retries are counted per function; use `log_stats()` at the end of a job to
+see which dependencies slowed it down.
+"""
+
+import functools
+import logging
+import os
+import random
+import threading
+import time
+
+from collections import defaultdict
+
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', '30.0'))
+# retries allowed across the whole process, 0 for no limit
+RETRY_BUDGET = int(os.environ.get('RETRY_BUDGET', '0'))
+# default seconds a call may spend waiting between attempts, unset or 0 for
+# no deadline
+RETRY_DEADLINE = float(os.environ.get('RETRY_DEADLINE', '0')) or None
+
+logger = logging.getLogger(__name__)
+
+
+class RetryBudget(object):
+    """
+    A thread-safe count of retries left for the whole process. A total of 0
+    or less means retries are not limited.
+    """
+
+    def __init__(self, total):
+        self.enabled = total > 0
+        self._remaining = total
+        self._lock = threading.Lock()
+
+    def consume(self):
+        """
+        :return: True if a retry may be made, False if the budget is spent
+        """
+        if not self.enabled:
+            return True
+
+        with self._lock:
+            if self._remaining <= 0:
+                return False
+
+            self._remaining -= 1
+            return True
+
+    @property
+    def remaining(self):
+        with self._lock:
+            return self._remaining
+
+
+class RetryStats(object):
+    """Calls, retries, failures and time spent sleeping per function."""
+
+    def __init__(self):
+        self._stats = defaultdict(lambda: {'calls': 0, 'retries': 0,
+                                           'failures': 0, 'slept': 0.0})
+        self._lock = threading.Lock()
+
+    def record(self, name, field, value=1):
+        with self._lock:
+            self._stats[name][field] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+
+budget = RetryBudget(RETRY_BUDGET)
+stats = RetryStats()
+
+
+def backoff_delay(attempt, delay, max_delay):
+    """
+    :param attempt: zero-based number of the failed attempt
+    :return: seconds to sleep, with full jitter
+    """
+    return random.uniform(0, min(max_delay, delay * (2 ** attempt)))
+
+
+def retry(retries=5, delay=2.0, max_delay=RETRY_MAX_DELAY,
+          deadline=RETRY_DEADLINE, exc_types=(Exception,), on_failure=None):
+    """
+    :param retries: maximum number of attempts
+    :param delay: base delay in seconds, doubled after each attempt
+    :param max_delay: upper bound of a single delay
+    :param deadline: seconds of waiting between attempts after which no
+                     further attempt is started; time spent in the calls
+                     themselves does not count. If None, every one of the
+                     `retries` attempts is made. Defaults to RETRY_DEADLINE
+    :param exc_types: exception types that trigger a retry
+    :param on_failure: called with the exception before it is re-raised
+    """
+    def decorator(func):
+        name = func.__name__
+
+        @functools.wraps(func)
+        def f_retry(*args, **kwargs):
+            stats.record(name, 'calls')
+            slept = 0.0
+            for i in range(retries):
+                try:
+                    return func(*args, **kwargs)
+                except exc_types as exc:
+                    sleep = backoff_delay(i, delay, max_delay)
+
+                    reason = None
+                    if i >= retries - 1:
+                        reason = 'failed after %d attempts' % retries
+                    elif deadline is not None and slept + sleep > deadline:
+                        reason = 'deadline of %.1fs exceeded' % deadline
+                    elif not budget.consume():
+                        reason = 'process retry budget exhausted'
+
+                    if reason:
+                        stats.record(name, 'failures')
+                        logger.exception('%s %s', name, reason)
+                        if on_failure is not None:
+                            on_failure(exc)
+
+                        raise
+
+                    slept += sleep
+                    stats.record(name, 'retries')
+                    stats.record(name, 'slept', sleep)
+                    logger.info('%s failed (attempt %d of %d), retrying in '
+                                '%.1fs', name, i + 1, retries, sleep)
+                    logger.debug('Caught exception, retrying...',
+                                 exc_info=True)
+                    time.sleep(sleep)
+        return f_retry
+    return decorator
+
+
+def log_stats(log=logger):
+    """Logs a summary of every function that needed a retry."""
+    retried = sorted((s['slept'], name, s)
+                     for name, s in stats.snapshot().items()
+                     if s['retries'] or s['failures'])
+    if not retried:
+        log.info('no retries were needed')
+        return
+
+    if budget.enabled:
+        log.info('retry summary (%d of %d budget left):',
+                 budget.remaining, RETRY_BUDGET)
+    else:
+        log.info('retry summary:')
+    for slept, name, s in reversed(retried):
+        log.info('  %s: %d calls, %d retries, %d failures, %.1fs waiting',
+                 name, s['calls'], s['retries'], s['failures'], slept)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Benchmarks the Kubernetes secret sync of mysql_init.py against the
+in-process FakeKubernetesAPI. MySQL is not involved.
+
+Each user of a generated preload gets its secret reconciled the way
+load_user() does it: the secret is looked up, its password reused or a new
+one generated, and the secret created or replaced if its fields differ.
+Three cases are run:
+
+ * `new`: none of the secrets exist yet
+ * `unchanged`: every secret exists and is up to date
+ * `changed`: every secret exists, but `--changed` of them are outdated
+
+Requires the same packages as mysql_init.py itself.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+from typing import Dict, List
+
+import kubernetes
+import mysql_init
+
+from kubernetes import KubernetesAPIClient
+
+# the fake API is shared by the benchmarks of all images
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'tools', 'fakes'))
+
+from fake_kubernetes_api import FakeKubernetesAPI
+
+MYSQL_HOST = 'mysql'
+MYSQL_PORT = 3306
+CASES = ('new', 'unchanged', 'changed')
+
+
+def _users(count: int, namespaces: int) -> List[Dict[str, str]]:
+    return [{
+        'username': 'user-{:d}'.format(i),
+        'secret': 'namespace-{:d}/user-{:d}-secret'.format(i % namespaces, i)
+    } for i in range(count)]
+
+
+def _fields(user: Dict[str, str], password: str) -> Dict[str, str]:
+    return {
+        'username': user['username'],
+        'password': password,
+        'host': MYSQL_HOST,
+        'port': str(MYSQL_PORT)
+    }
+
+
+def _seed(api: FakeKubernetesAPI, case: str, users: List[Dict[str, str]],
+          namespaces: int, changed: float):
+    for i in range(namespaces):
+        api.add_namespace('namespace-{:d}'.format(i))
+
+    if case != 'new':
+        outdated = int(round(len(users) * changed)) if case == 'changed' \
+            else 0
+        for i, user in enumerate(users):
+            namespace, name = mysql_init.parse_secret(user['secret'])
+            fields = _fields(user, 'password-{:d}'.format(i))
+            if i < outdated:
+                fields['host'] = 'old-mysql'
+            api.add_secret(namespace, name, fields,
+                           labels={'heritage': 'mysql-users-init-job'})
+
+    api.reset_counts()
+
+
+def sync_secret(user: Dict[str, str]):
+    """The secret handling of mysql_init.load_user()"""
+    namespace, name = mysql_init.parse_secret(user['secret'])
+    secret = mysql_init.get_kubernetes_secret(name, namespace)
+    if secret:
+        password = mysql_init.get_password(secret)
+    else:
+        password = mysql_init.generate_password()
+
+    mysql_init.ensure_kubernetes_secret(secret, _fields(user, password),
+                                        user['secret'])
+
+
+def run_case(args: argparse.Namespace, case: str) -> Dict:
+    api = FakeKubernetesAPI(latency=args.latency)
+    api.start()
+    try:
+        users = _users(args.users, args.namespaces)
+        _seed(api, case, users, args.namespaces, args.changed)
+
+        client = KubernetesAPIClient(qps=args.qps, burst=args.burst)
+        client.api_url = api.url
+
+        mysql_init._kubernetes_client = client
+        mysql_init._secret_cache = mysql_init.SecretCache(
+            list_namespaces=args.list_secrets)
+
+        start = time.time()
+        for user in users:
+            sync_secret(user)
+        elapsed = time.time() - start
+
+        return {
+            'case': case,
+            'users': args.users,
+            'seconds': elapsed,
+            'calls': api.total_calls(),
+            'call_counts': api.call_counts(),
+        }
+    finally:
+        api.stop()
+
+
+def _get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='secret_sync_benchmark',
+        description='Benchmark mysql-users-init secret sync against a '
+                    'fake Kubernetes API')
+    parser.add_argument('--users', type=int, default=500,
+                        help='Number of users with a secret in the preload')
+    parser.add_argument('--namespaces', type=int, default=1,
+                        help='Number of namespaces the secrets are spread '
+                             'over')
+    parser.add_argument('--changed', type=float, default=0.1,
+                        help='Fraction of secrets outdated in the `changed` '
+                             'case')
+    parser.add_argument('--cases', default=','.join(CASES),
+                        help='Comma separated cases to run')
+    parser.add_argument('--list-secrets', action='store_true',
+                        help='List each namespace once (SECRET_LIST) instead '
+                             'of reading secrets one by one')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Seconds of latency added to every API request')
+    parser.add_argument('--qps', type=float, default=kubernetes.QPS,
+                        help='Client side request rate limit, 0 to disable')
+    parser.add_argument('--burst', type=int, default=kubernetes.BURST,
+                        help='Client side request burst')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Show job logs and API calls per verb')
+    return parser
+
+
+def main(args=None):
+    args = _get_parser().parse_args(args)
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    print('{:>10} {:>6} {:>10} {:>8}'.format(
+        'case', 'users', 'seconds', 'calls'))
+    for case in args.cases.split(','):
+        result = run_case(args, case)
+        print('{case:>10} {users:>6d} {seconds:>10.3f} '
+              '{calls:>8d}'.format(**result))
+        if args.verbose:
+            for call, n in sorted(result['call_counts'].items()):
+                print('    {:<28} {:>8d}'.format(call, n))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,878 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+In-process stand-in for the parts of the Kubernetes API used by the init and
+cleanup jobs: namespaces, secrets, configmaps, pods and jobs.
+
+Supported requests:
+ * list, with `labelSelector`, `fieldSelector` and `limit`/`continue` paging
+ * watch (`watch=true`), streaming events from a `resourceVersion`, with
+   optional bookmarks and 410 Gone once a version has been compacted away
+ * get, create (POST), replace (PUT) and delete, including `deletecollection`
+   (DELETE on a collection) and cascading job deletes
+ * PATCH using JSON patch or merge patch
+
+Every request is counted per verb and resource so callers can report how
+many API calls a run needed. A fixed latency can be added to each request.
+There is no job controller: `add_job` creates a job along with its pods and
+`complete_job` marks it complete.
+
+Usage:
+
+    api = FakeKubernetesAPI(latency=0.002)
+    api.start()
+    client = KubernetesAPIClient()
+    client.api_url = api.url
+    ...
+    print(api.call_counts())
+    api.stop()
+"""
+
+from __future__ import print_function
+
+import base64
+import collections
+import copy
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+    from urlparse import urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+    from urllib.parse import urlparse
+
+# label selectors are evaluated by the code job-cleanup itself uses, appended
+# so job-cleanup's other modules never shadow those of the calling benchmark
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, os.pardir, 'job-cleanup'))
+
+from label_selector import selector_matches
+from label_selector import split_selector
+
+# resource -> (API prefix, kind, namespaced)
+RESOURCES = {
+    'namespaces': ('/api/v1', 'Namespace', False),
+    'secrets': ('/api/v1', 'Secret', True),
+    'configmaps': ('/api/v1', 'ConfigMap', True),
+    'pods': ('/api/v1', 'Pod', True),
+    'jobs': ('/apis/batch/v1', 'Job', True),
+}
+
+DEFAULT_WATCH_TIMEOUT = 60
+DEFAULT_HISTORY = 10000
+STOP_TIMEOUT = 5.0
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients going away, e.g. in the middle of a watch, or connections
+        # closed by stop() aren't worth a traceback
+        if not isinstance(sys.exc_info()[1], (IOError, OSError)):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class FakeKubernetesError(Exception):
+    def __init__(self, code, reason, message):
+        super(FakeKubernetesError, self).__init__(message)
+        self.code = code
+        self.reason = reason
+
+    def status(self):
+        return {'kind': 'Status', 'apiVersion': 'v1', 'metadata': {},
+                'status': 'Failure', 'message': str(self),
+                'reason': self.reason, 'code': self.code}
+
+
+def match_labels(selector, labels):
+    """
+    :param selector: label selector, e.g. `app=foo,component!=bar,!defunct`
+    :param labels: labels of an object, may be None
+    :return: True if the labels satisfy every term of the selector
+    """
+    return selector_matches(selector, labels)
+
+
+def match_fields(selector, obj):
+    """
+    :param selector: field selector, e.g. `metadata.name=foo`
+    :return: True if the object satisfies every term of the selector
+    """
+    for term in split_selector(selector):
+        negate = '!=' in term
+        field, value = term.replace('!=', '=').replace('==', '=').split('=', 1)
+        current = obj
+        for part in field.strip().split('.'):
+            current = current.get(part) if isinstance(current, dict) else None
+        current = '' if current is None else str(current)
+        if (current == value.strip()) == negate:
+            return False
+
+    return True
+
+
+def _pointer(path):
+    return [part.replace('~1', '/').replace('~0', '~')
+            for part in path.lstrip('/').split('/')]
+
+
+def apply_json_patch(obj, ops):
+    """
+    Applies RFC 6902 `add`, `replace`, `remove` and `test` operations.
+
+    :return: the patched copy of obj
+    """
+    obj = copy.deepcopy(obj)
+    for op in ops:
+        parts = _pointer(op['path'])
+        parent = obj
+        for part in parts[:-1]:
+            if isinstance(parent, list):
+                part = int(part)
+            elif part not in parent:
+                if op['op'] != 'add':
+                    raise FakeKubernetesError(
+                        422, 'Invalid', 'path not found: ' + op['path'])
+                # kubernetes is lenient here, unlike RFC 6902
+                parent[part] = {}
+            parent = parent[part]
+
+        key = parts[-1]
+        if isinstance(parent, list):
+            key = len(parent) if key == '-' else int(key)
+            exists = key < len(parent)
+        else:
+            exists = key in parent
+
+        if op['op'] == 'add':
+            if isinstance(parent, list):
+                parent.insert(key, op['value'])
+            else:
+                parent[key] = op['value']
+        elif op['op'] in ('replace', 'remove', 'test') and not exists:
+            raise FakeKubernetesError(422, 'Invalid',
+                                      'path not found: ' + op['path'])
+        elif op['op'] == 'replace':
+            parent[key] = op['value']
+        elif op['op'] == 'remove':
+            del parent[key]
+        elif op['op'] == 'test':
+            if parent[key] != op['value']:
+                raise FakeKubernetesError(422, 'Invalid',
+                                          'test failed: ' + op['path'])
+        else:
+            raise FakeKubernetesError(422, 'Invalid',
+                                      'unsupported op: ' + op['op'])
+
+    return obj
+
+
+def apply_merge_patch(obj, patch):
+    """RFC 7386 merge patch, also used for strategic merge patches"""
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+
+    merged = copy.deepcopy(obj) if isinstance(obj, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            merged.pop(key, None)
+        else:
+            merged[key] = apply_merge_patch(merged.get(key), value)
+
+    return merged
+
+
+class FakeKubernetesAPI(object):
+    """Serves in-memory Kubernetes objects over HTTP
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0,
+                 history=DEFAULT_HISTORY, bookmark_interval=None):
+        """
+        :param latency: seconds added to every request
+        :param history: watch events retained; watches from an older
+                        resourceVersion get 410 Gone
+        :param bookmark_interval: seconds between BOOKMARK events sent to
+                                  idle watches that allow them, None to
+                                  never send any
+        """
+        self.latency = latency
+        self.bookmark_interval = bookmark_interval
+        self._cond = threading.Condition(threading.RLock())
+        self._version = 0
+        self._compacted = 0
+        self._events = collections.deque(maxlen=history)
+        self._calls = collections.Counter()
+        self._store = {resource: {} for resource in RESOURCES}
+        self._stopping = False
+        self._connections = set()
+        self._watches = 0
+
+        api = self
+
+        class Handler(_FakeKubernetesHandler):
+            fake_api = api
+
+        self._server = _ThreadingHTTPServer((host, port), Handler)
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the server. Open watches are ended with an ERROR event so
+        clients don't try to resume them, and idle keep-alive connections
+        are closed.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+        give_up_at = time.time() + STOP_TIMEOUT
+        with self._cond:
+            while self._watches and time.time() < give_up_at:
+                self._cond.wait(0.1)
+            connections = list(self._connections)
+
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except (IOError, OSError):
+                pass
+
+        with self._cond:
+            while self._connections and time.time() < give_up_at:
+                self._cond.wait(0.1)
+
+    def connected(self, connection):
+        with self._cond:
+            self._connections.add(connection)
+
+    def disconnected(self, connection):
+        with self._cond:
+            self._connections.discard(connection)
+            self._cond.notify_all()
+
+    def watch_started(self):
+        with self._cond:
+            self._watches += 1
+
+    def watch_ended(self):
+        with self._cond:
+            self._watches -= 1
+            self._cond.notify_all()
+
+    # counters
+
+    def record_call(self, verb, resource):
+        with self._cond:
+            self._calls[(verb, resource)] += 1
+
+    def call_counts(self):
+        """Return a dict of 'verb resource' -> number of requests
+        """
+        with self._cond:
+            return {'{} {}'.format(verb, resource): count
+                    for (verb, resource), count in self._calls.items()}
+
+    def total_calls(self):
+        with self._cond:
+            return sum(self._calls.values())
+
+    def reset_counts(self):
+        with self._cond:
+            self._calls.clear()
+
+    # storage, callers must hold self._cond
+
+    def _record(self, event_type, resource, obj):
+        if len(self._events) == self._events.maxlen:
+            self._compacted = self._events[0][0]
+        self._events.append((self._version, event_type, resource,
+                             copy.deepcopy(obj)))
+        self._cond.notify_all()
+
+    def _bump(self, obj):
+        self._version += 1
+        obj['metadata']['resourceVersion'] = str(self._version)
+
+    def _put(self, resource, namespace, obj, event_type):
+        self._bump(obj)
+        self._store[resource][(namespace, obj['metadata']['name'])] = obj
+        self._record(event_type, resource, obj)
+        return copy.deepcopy(obj)
+
+    def _remove(self, resource, key):
+        obj = self._store[resource].pop(key)
+        self._bump(obj)
+        self._record('DELETED', resource, obj)
+
+        if resource == 'namespaces':
+            for other in RESOURCES:
+                for other_key in [k for k in self._store[other]
+                                  if k[0] == key[1]]:
+                    self._remove(other, other_key)
+
+        return obj
+
+    def _check_namespace(self, resource, namespace):
+        if RESOURCES[resource][2] and \
+                ('', namespace) not in self._store['namespaces']:
+            raise FakeKubernetesError(
+                404, 'NotFound', 'namespaces "{}" not found'.format(namespace))
+
+    def _matching(self, resource, namespace, label_selector, field_selector):
+        keys = sorted(key for key in self._store[resource]
+                      if namespace is None or key[0] == namespace)
+        objects = [self._store[resource][key] for key in keys]
+        return [(key, obj) for key, obj in zip(keys, objects)
+                if match_labels(label_selector,
+                                obj['metadata'].get('labels'))
+                and match_fields(field_selector, obj)]
+
+    # operations, also used directly to seed and inspect state
+
+    def create(self, resource, namespace, obj):
+        """
+        :param namespace: namespace, or None for namespaces themselves
+        :return: the created object
+        """
+        obj = copy.deepcopy(obj)
+        namespace = namespace or ''
+        with self._cond:
+            self._check_namespace(resource, namespace)
+
+            metadata = obj.setdefault('metadata', {})
+            if 'name' not in metadata and 'generateName' in metadata:
+                metadata['name'] = metadata['generateName'] + \
+                    uuid.uuid4().hex[:5]
+            if (namespace, metadata.get('name')) in self._store[resource]:
+                raise FakeKubernetesError(
+                    409, 'AlreadyExists', '{} "{}" already exists'.format(
+                        resource, metadata.get('name')))
+
+            prefix, kind, namespaced = RESOURCES[resource]
+            obj['kind'] = kind
+            obj['apiVersion'] = prefix.split('/', 2)[-1]
+            if namespaced:
+                metadata['namespace'] = namespace
+            metadata['uid'] = str(uuid.uuid4())
+            metadata['creationTimestamp'] = time.strftime(
+                '%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+            return self._put(resource, namespace, obj, 'ADDED')
+
+    def get(self, resource, namespace, name):
+        """
+        :return: a copy of the object, or None if it doesn't exist
+        """
+        with self._cond:
+            obj = self._store[resource].get((namespace or '', name))
+            return None if obj is None else copy.deepcopy(obj)
+
+    def replace(self, resource, namespace, name, obj):
+        obj = copy.deepcopy(obj)
+        namespace = namespace or ''
+        with self._cond:
+            current = self._store[resource].get((namespace, name))
+            if current is None:
+                raise FakeKubernetesError(
+                    404, 'NotFound', '{} "{}" not found'.format(resource,
+                                                                name))
+
+            metadata = obj.setdefault('metadata', {})
+            version = metadata.get('resourceVersion')
+            if version and version != current['metadata']['resourceVersion']:
+                raise FakeKubernetesError(
+                    409, 'Conflict', 'the object has been modified')
+
+            for field in ('name', 'namespace', 'uid', 'creationTimestamp'):
+                if field in current['metadata']:
+                    metadata[field] = current['metadata'][field]
+            obj['kind'] = current['kind']
+            obj['apiVersion'] = current['apiVersion']
+            return self._put(resource, namespace, obj, 'MODIFIED')
+
+    def patch(self, resource, namespace, name, patch, json_patch=True):
+        with self._cond:
+            current = self._store[resource].get((namespace or '', name))
+            if current is None:
+                raise FakeKubernetesError(
+                    404, 'NotFound', '{} "{}" not found'.format(resource,
+                                                                name))
+
+            if json_patch:
+                patched = apply_json_patch(current, patch)
+            else:
+                patched = apply_merge_patch(current, patch)
+            patched['metadata'].pop('resourceVersion', None)
+            return self.replace(resource, namespace, name, patched)
+
+    def delete(self, resource, namespace, name, propagation=None):
+        """
+        Deletes an object immediately. Deleting a job with a `Background` or
+        `Foreground` propagation policy also deletes its pods, and deleting
+        a namespace deletes everything in it.
+
+        :return: the deleted object
+        """
+        namespace = namespace or ''
+        with self._cond:
+            key = (namespace, name)
+            if key not in self._store[resource]:
+                raise FakeKubernetesError(
+                    404, 'NotFound', '{} "{}" not found'.format(resource,
+                                                                name))
+
+            obj = self._remove(resource, key)
+            if resource == 'jobs' and propagation in ('Background',
+                                                      'Foreground'):
+                selector = 'job-name={}'.format(name)
+                for pod_key, _ in self._matching('pods', namespace, selector,
+                                                 None):
+                    self._remove('pods', pod_key)
+
+            return copy.deepcopy(obj)
+
+    def delete_collection(self, resource, namespace, label_selector=None,
+                          field_selector=None):
+        """
+        :return: the deleted objects
+        """
+        with self._cond:
+            matching = self._matching(resource, namespace or '',
+                                      label_selector, field_selector)
+            return [copy.deepcopy(self._remove(resource, key))
+                    for key, _ in matching]
+
+    def list(self, resource, namespace=None, label_selector=None,
+             field_selector=None, limit=None, continue_token=None):
+        """
+        :param namespace: namespace, or None to list across all namespaces
+        :return: a list object, with `metadata.continue` set if a `limit`
+                 was given and more items remain
+        """
+        with self._cond:
+            start = None
+            if continue_token:
+                try:
+                    token = json.loads(base64.b64decode(
+                        continue_token.encode('utf-8')).decode('utf-8'))
+                except ValueError:
+                    raise FakeKubernetesError(400, 'BadRequest',
+                                              'invalid continue token')
+                if token['rv'] < self._compacted:
+                    raise FakeKubernetesError(
+                        410, 'Expired', 'The provided continue parameter is '
+                                        'too old')
+                start = tuple(token['start'])
+
+            matching = self._matching(resource, namespace, label_selector,
+                                      field_selector)
+            if start is not None:
+                matching = [(k, obj) for k, obj in matching if k > start]
+
+            metadata = {'resourceVersion': str(self._version)}
+            if limit and len(matching) > limit:
+                matching = matching[:limit]
+                token = {'rv': self._version, 'start': list(matching[-1][0])}
+                metadata['continue'] = base64.b64encode(
+                    json.dumps(token).encode('utf-8')).decode('utf-8')
+
+            prefix, kind, _ = RESOURCES[resource]
+            return {'kind': kind + 'List',
+                    'apiVersion': prefix.split('/', 2)[-1],
+                    'metadata': metadata,
+                    'items': [copy.deepcopy(obj) for _, obj in matching]}
+
+    def compact(self):
+        """
+        Drops all watch history, so watches and continue tokens from
+        earlier versions fail with 410 Gone.
+        """
+        with self._cond:
+            self._events.clear()
+            self._compacted = self._version
+
+    def events_since(self, version, timeout):
+        """
+        Waits up to `timeout` seconds for events newer than `version`.
+
+        :return: list of (version, type, resource, object), or None if the
+                 version has been compacted
+        """
+        with self._cond:
+            if version < self._compacted:
+                return None
+
+            if not self._events or self._events[-1][0] <= version:
+                if self._stopping:
+                    return []
+                self._cond.wait(timeout)
+
+            if version < self._compacted:
+                return None
+
+            events = []
+            for event in reversed(self._events):
+                if event[0] <= version:
+                    break
+                events.append(event)
+            events.reverse()
+            return events
+
+    @property
+    def resource_version(self):
+        with self._cond:
+            return self._version
+
+    @property
+    def stopping(self):
+        with self._cond:
+            return self._stopping
+
+    # helpers
+
+    def add_namespace(self, name):
+        if self.get('namespaces', None, name) is None:
+            self.create('namespaces', None, {'metadata': {'name': name}})
+
+    def add_secret(self, namespace, name, data, labels=None):
+        """
+        :param data: dict of field -> plain text value
+        """
+        encoded = {k: base64.b64encode(v.encode('utf-8')).decode('utf-8')
+                   for k, v in data.items()}
+        return self.create('secrets', namespace, {
+            'type': 'Opaque',
+            'metadata': {'name': name, 'labels': labels or {}},
+            'data': encoded
+        })
+
+    def add_pod(self, namespace, name, labels=None, phase='Running'):
+        return self.create('pods', namespace, {
+            'metadata': {'name': name, 'labels': labels or {}},
+            'spec': {'containers': [{'name': 'main', 'image': 'busybox'}]},
+            'status': {'phase': phase}
+        })
+
+    def add_job(self, namespace, name, labels=None, pods=1, complete=False):
+        """
+        Creates a job and `pods` pods labelled with its `job-name`, the way
+        the job controller would.
+        """
+        labels = dict(labels or {})
+        job = self.create('jobs', namespace, {
+            'metadata': {'name': name, 'labels': labels},
+            'spec': {'completions': 1, 'backoffLimit': 6},
+            'status': {}
+        })
+
+        pod_labels = dict(labels)
+        pod_labels['job-name'] = name
+        pod_labels['controller-uid'] = job['metadata']['uid']
+        for i in range(pods):
+            self.add_pod(namespace, '{}-{:d}'.format(name, i), pod_labels,
+                         phase='Running')
+
+        if complete:
+            job = self.complete_job(namespace, name)
+
+        return job
+
+    def complete_job(self, namespace, name):
+        """Marks a job and its pods as succeeded
+        """
+        with self._cond:
+            selector = 'job-name={}'.format(name)
+            for key, pod in self._matching('pods', namespace, selector, None):
+                pod = copy.deepcopy(pod)
+                pod['status']['phase'] = 'Succeeded'
+                self._put('pods', namespace, pod, 'MODIFIED')
+
+            job = copy.deepcopy(self._store['jobs'][(namespace, name)])
+            job['status'] = {
+                'succeeded': 1,
+                'conditions': [{'type': 'Complete', 'status': 'True'}]
+            }
+            return self._put('jobs', namespace, job, 'MODIFIED')
+
+
+class _FakeKubernetesHandler(BaseHTTPRequestHandler):
+    fake_api = None
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, don't let Nagle's algorithm
+    # hold back the body waiting for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.fake_api.connected(self.connection)
+
+    def finish(self):
+        self.fake_api.disconnected(self.connection)
+        BaseHTTPRequestHandler.finish(self)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _route(self):
+        """
+        :return: (resource, namespace, name, query); resource is None if the
+                 path isn't served
+        """
+        parsed = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        parts = [part for part in parsed.path.split('/') if part]
+
+        for resource, (prefix, _, namespaced) in RESOURCES.items():
+            prefix_parts = prefix.strip('/').split('/')
+            if parts[:len(prefix_parts)] != prefix_parts:
+                continue
+
+            rest = parts[len(prefix_parts):]
+            if not namespaced and rest[:1] == [resource] and len(rest) <= 2:
+                return resource, None, (rest[1:] or [None])[0], query
+
+            if namespaced and len(rest) in (3, 4) and \
+                    rest[0] == 'namespaces' and rest[2] == resource:
+                return resource, rest[1], (rest[3:] or [None])[0], query
+
+        return None, None, None, query
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def _send(self, status, body=None):
+        data = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if data:
+            self.wfile.write(data)
+
+    def _write_chunk(self, data):
+        self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii'))
+        self.wfile.write(data + b'\r\n')
+        self.wfile.flush()
+
+    def _watch(self, resource, namespace, query):
+        api = self.fake_api
+        label_selector = query.get('labelSelector')
+        field_selector = query.get('fieldSelector')
+        bookmarks = query.get('allowWatchBookmarks') == 'true' and \
+            api.bookmark_interval
+        timeout = float(query.get('timeoutSeconds', DEFAULT_WATCH_TIMEOUT))
+        deadline = time.time() + timeout
+        kind = RESOURCES[resource][1]
+
+        def send(event_type, obj):
+            line = json.dumps({'type': event_type, 'object': obj}) + '\n'
+            self._write_chunk(line.encode('utf-8'))
+
+        api.watch_started()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+
+            version = query.get('resourceVersion')
+            if version in (None, '', '0'):
+                listing = api.list(resource, namespace, label_selector,
+                                   field_selector)
+                for obj in listing['items']:
+                    send('ADDED', obj)
+                version = listing['metadata']['resourceVersion']
+            version = int(version)
+
+            while True:
+                if api.stopping:
+                    send('ERROR', FakeKubernetesError(
+                        503, 'ServiceUnavailable',
+                        'the server is shutting down').status())
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                wait = remaining
+                if bookmarks:
+                    wait = min(wait, api.bookmark_interval)
+                events = api.events_since(version, wait)
+                if events is None:
+                    send('ERROR', FakeKubernetesError(
+                        410, 'Expired', 'too old resource version: '
+                                        '{}'.format(version)).status())
+                    break
+
+                if not events and bookmarks:
+                    send('BOOKMARK', {
+                        'kind': kind,
+                        'metadata': {
+                            'resourceVersion': str(api.resource_version)}})
+                    continue
+
+                for event_version, event_type, event_resource, obj \
+                        in events:
+                    version = event_version
+                    if event_resource != resource:
+                        continue
+                    if namespace is not None and \
+                            obj['metadata'].get('namespace') != namespace:
+                        continue
+                    if not match_labels(label_selector,
+                                        obj['metadata'].get('labels')) or \
+                            not match_fields(field_selector, obj):
+                        continue
+                    send(event_type, obj)
+
+            self._write_chunk(b'')
+        except (IOError, OSError):
+            # the client went away
+            self.close_connection = True
+        finally:
+            api.watch_ended()
+
+    def _handle(self, method):
+        api = self.fake_api
+        resource, namespace, name, query = self._route()
+        if api.latency:
+            time.sleep(api.latency)
+        if resource is None:
+            self._send(404, FakeKubernetesError(
+                404, 'NotFound', 'the server could not find the requested '
+                                 'resource').status())
+            return
+
+        label_selector = query.get('labelSelector')
+        field_selector = query.get('fieldSelector')
+        watch = query.get('watch') in ('true', '1')
+
+        if method == 'GET' and name is None and watch:
+            verb = 'watch'
+        elif method == 'GET' and name is None:
+            verb = 'list'
+        elif method == 'GET':
+            verb = 'get'
+        elif method == 'POST' and name is None:
+            verb = 'create'
+        elif method == 'PUT' and name is not None:
+            verb = 'update'
+        elif method == 'PATCH' and name is not None:
+            verb = 'patch'
+        elif method == 'DELETE' and name is None:
+            verb = 'deletecollection'
+        elif method == 'DELETE':
+            verb = 'delete'
+        else:
+            self._send(405, FakeKubernetesError(
+                405, 'MethodNotAllowed', 'method not allowed').status())
+            return
+        api.record_call(verb, resource)
+
+        try:
+            if verb == 'watch':
+                self._watch(resource, namespace, query)
+            elif verb == 'list':
+                limit = int(query.get('limit') or 0) or None
+                self._send(200, api.list(resource, namespace, label_selector,
+                                         field_selector, limit,
+                                         query.get('continue')))
+            elif verb == 'get':
+                obj = api.get(resource, namespace, name)
+                if obj is None:
+                    raise FakeKubernetesError(
+                        404, 'NotFound', '{} "{}" not found'.format(resource,
+                                                                    name))
+                self._send(200, obj)
+            elif verb == 'create':
+                self._send(201, api.create(resource, namespace,
+                                           self._read_body()))
+            elif verb == 'update':
+                self._send(200, api.replace(resource, namespace, name,
+                                            self._read_body()))
+            elif verb == 'patch':
+                content_type = self.headers.get('Content-Type', '')
+                self._send(200, api.patch(
+                    resource, namespace, name, self._read_body(),
+                    json_patch=content_type.startswith(
+                        'application/json-patch+json')))
+            elif verb == 'deletecollection':
+                self._read_body()
+                items = api.delete_collection(resource, namespace,
+                                              label_selector, field_selector)
+                prefix, kind, _ = RESOURCES[resource]
+                self._send(200, {'kind': kind + 'List',
+                                 'apiVersion': prefix.split('/', 2)[-1],
+                                 'metadata': {},
+                                 'items': items})
+            else:
+                options = self._read_body()
+                propagation = options.get('propagationPolicy') or \
+                    query.get('propagationPolicy')
+                self._send(200, api.delete(resource, namespace, name,
+                                           propagation))
+        except FakeKubernetesError as e:
+            self._send(e.code, e.status())
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
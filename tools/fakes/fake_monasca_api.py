@@ -0,0 +1,285 @@
+#!/usr/bin/python
+# coding=utf-8
+
+# (c) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function
+'''
+In-process stand-in for the parts of the Monasca API used by
+monasca_alarm_definition.py: the notification-methods and alarm-definitions
+collections. Lists are paged the way the real API pages them, using `limit`
+and an `offset` holding the last id of the previous page.
+
+Every request is counted per method and collection so callers can report how
+many API calls a run needed. A fixed latency can be added to each request.
+
+Usage:
+
+    api = FakeMonascaAPI(latency=0.002, page_size=1000)
+    api.start()
+    ... point the loader at api.url ...
+    print(api.call_counts())
+    api.stop()
+'''
+
+import collections
+import json
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+    from urlparse import urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+    from urllib.parse import urlparse
+
+API_PREFIX = '/v2.0'
+DEFAULT_PAGE_SIZE = 10000
+
+COLLECTIONS = {
+    'notification-methods': {
+        'name': '',
+        'type': 'EMAIL',
+        'address': '',
+        'period': 0,
+    },
+    'alarm-definitions': {
+        'name': '',
+        'description': '',
+        'expression': '',
+        'deterministic': False,
+        'match_by': [],
+        'severity': 'LOW',
+        'actions_enabled': True,
+        'alarm_actions': [],
+        'ok_actions': [],
+        'undetermined_actions': [],
+    },
+}
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeMonascaAPI(object):
+    """Serves in-memory notifications and alarm definitions over HTTP
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0,
+                 page_size=DEFAULT_PAGE_SIZE):
+        self.latency = latency
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._calls = collections.Counter()
+        self._store = {name: {} for name in COLLECTIONS}
+
+        api = self
+
+        class Handler(_FakeMonascaHandler):
+            fake_api = api
+
+        self._server = _ThreadingHTTPServer((host, port), Handler)
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}{}'.format(host, port, API_PREFIX)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _new_id(self):
+        self._next_id += 1
+        # Fixed width keeps lexical and creation order identical, which is
+        # what offset based paging relies on
+        return '{:012x}'.format(self._next_id)
+
+    def add(self, collection, **fields):
+        """Insert an element directly, bypassing the HTTP layer and counters
+        """
+        with self._lock:
+            element = dict(COLLECTIONS[collection])
+            element.update(fields)
+            element['id'] = self._new_id()
+            self._store[collection][element['id']] = element
+            return dict(element)
+
+    def elements(self, collection):
+        with self._lock:
+            return [dict(self._store[collection][key])
+                    for key in sorted(self._store[collection])]
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+            for collection in self._store.values():
+                collection.clear()
+
+    def record_call(self, method, collection):
+        with self._lock:
+            self._calls[(method, collection)] += 1
+
+    def call_counts(self):
+        """Return a dict of 'METHOD collection' -> number of requests
+        """
+        with self._lock:
+            return {'{} {}'.format(method, collection): count
+                    for (method, collection), count in self._calls.items()}
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self._calls.values())
+
+    def list_page(self, collection, offset=None, limit=None):
+        limit = min(limit or self.page_size, self.page_size)
+        with self._lock:
+            keys = sorted(self._store[collection])
+            if offset:
+                keys = [key for key in keys if key > offset]
+            page = [dict(self._store[collection][key]) for key in keys[:limit]]
+            more = len(keys) > limit
+        return page, more, limit
+
+    def get(self, collection, element_id):
+        with self._lock:
+            element = self._store[collection].get(element_id)
+            return None if element is None else dict(element)
+
+    def create(self, collection, fields):
+        return self.add(collection, **fields)
+
+    def update(self, collection, element_id, fields):
+        with self._lock:
+            element = self._store[collection].get(element_id)
+            if element is None:
+                return None
+            element.update(fields)
+            element['id'] = element_id
+            return dict(element)
+
+    def delete(self, collection, element_id):
+        with self._lock:
+            return self._store[collection].pop(element_id, None) is not None
+
+
+class _FakeMonascaHandler(BaseHTTPRequestHandler):
+    fake_api = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _route(self):
+        parsed = urlparse(self.path)
+        path = parsed.path
+        if path.startswith(API_PREFIX):
+            path = path[len(API_PREFIX):]
+        parts = [part for part in path.split('/') if part]
+        if not parts or parts[0] not in COLLECTIONS or len(parts) > 2:
+            return None, None, parse_qs(parsed.query)
+        element_id = parts[1] if len(parts) == 2 else None
+        return parts[0], element_id, parse_qs(parsed.query)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def _send(self, status, body=None):
+        data = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if data:
+            self.wfile.write(data)
+
+    def _handle(self, method):
+        api = self.fake_api
+        collection, element_id, query = self._route()
+        if api.latency:
+            time.sleep(api.latency)
+        if collection is None:
+            self._send(404, {'message': 'Not Found'})
+            return
+        api.record_call(method, collection)
+
+        if method == 'GET' and element_id is None:
+            offset = query.get('offset', [None])[0]
+            limit = int(query.get('limit', [0])[0]) or None
+            page, more, limit = api.list_page(collection, offset, limit)
+            base = '{}/{}'.format(api.url, collection)
+            links = [{'rel': 'self', 'href': base}]
+            if more:
+                links.append({'rel': 'next',
+                              'href': '{}?offset={}&limit={}'.format(
+                                  base, page[-1]['id'], limit)})
+            self._send(200, {'links': links, 'elements': page})
+        elif method == 'GET':
+            element = api.get(collection, element_id)
+            if element is None:
+                self._send(404, {'message': 'Not Found'})
+            else:
+                self._send(200, element)
+        elif method == 'POST' and element_id is None:
+            self._send(201, api.create(collection, self._read_body()))
+        elif method in ('PATCH', 'PUT') and element_id is not None:
+            element = api.update(collection, element_id, self._read_body())
+            if element is None:
+                self._send(404, {'message': 'Not Found'})
+            else:
+                self._send(200, element)
+        elif method == 'DELETE' and element_id is not None:
+            if api.delete(collection, element_id):
+                self._send(204)
+            else:
+                self._send(404, {'message': 'Not Found'})
+        else:
+            self._send(405, {'message': 'Method Not Allowed'})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')